@@ -1,7 +1,12 @@
+import time
+import heapq
+import bisect
 import numpy as np
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Tuple
 from image_distribution import ImageDistribution
-from utility import in_bound
+from utility import in_bound, luby, get_seed
 
 class WeightingOptions:
     UNIFORM = 1 # Uniform Distribution
@@ -11,6 +16,7 @@ class WeightingOptions:
 class UpdatingOptions:
     NEIGHBOR = 1 # Experimental, propagates the constraints only to immediate neighbors
     CHAIN = 2 #Gumin's
+    AC4 = 3 # keeps support counters per (position, unit, direction) and propagates every ban, not only collapses
 
 class EntropyOptions:
     NUMBER_OF_OPTIONS = 1
@@ -18,45 +24,131 @@ class EntropyOptions:
     TOP_LEFT = 3
     TOP_RIGHT = 4
 
+class RestartOptions:
+    NONE = 1 # keep backtracking until a result is found or every option is tested
+    LUBY = 2 # start again after restart_base * luby(i) backtracks in the i-th run
+    GEOMETRIC = 3 # start again after restart_base * restart_factor^i backtracks in the i-th run
+
 class ExistingTile:
   def __init__(self, pos: Tuple[int, int], tile_number: int):
     self.pos = pos
     self.tile_number = tile_number
 
 class WFC:
+    # methods timed by enable_profiling, and the phase they are counted in
+    PROFILED_PHASES = {'_get_initial_supermap': 'initialization', '_get_position_to_collapse': 'selection', '_choose': 'decision',
+                       '_get_weights': 'weighting', '_update_supermap_from': 'propagation', '_undo': 'backtracking'}
+    CONTEXT_WEIGHTS_MEMORY = 2**24 # bytes of context weight vectors kept for CONTEXT_SENSITIVE weighting
+
     def __init__(self, dist: ImageDistribution, weighting_option, updating_option, entropy_option):
         self.dist = dist
         self.updating_option = updating_option
         self.entropy_option = entropy_option
         self.weighting_option = weighting_option
+        self._ban_queue = deque()
+        self._supports = None
+        self._counts = None
+        self._trail = None # (x, y, unit indices, supports) entries to undo when backtracking, None when not recording
+        self._supermap = None
+        self._context_weights = OrderedDict()
+        self._opposite = np.array([ImageDistribution.MOVESET.index((-dx, -dy)) for dx, dy in ImageDistribution.MOVESET])
+        self._moves = np.array(ImageDistribution.MOVESET)
+        self.rng = np.random.Generator(np.random.PCG64(0)) # reset from the seed of each generate call
+        self.conflicting_tiles = [] # positions of the existing tiles that couldn't be placed, in the last generate call
+        self._reset_stats()
+        self.observers = []
+        self.timings = None # seconds spent in each phase while profiling, see enable_profiling
+        self._timer_stack = []
+
+    # The supermap (wave) is a (H, W, n_units) boolean array: supermap[x, y, u] is True while unit index u
+    # (see ImageDistribution.units) is still a possible option at (x, y).
+
+    def _reset_stats(self):
+        # counters of the last generate call: collapsed positions, positions taken from the propagation queue,
+        # positions left without options, and the backtracking counters of generate_bt
+        # and the options removed and positions pushed to the propagation queues
+        self.stats = {'steps': 0, 'propagations': 0, 'contradictions': 0, 'backtracks': 0, 'backjumps': 0, 'restarts': 0,
+                      'removed': 0, 'queued': 0}
+
+    def add_observer(self, observer):
+        # observer(wfc, supermap) is called with the initial supermap and after each step of generate, e.g. a GifMaker or a progress bar
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        self.observers.remove(observer)
+
+    def _notify(self, supermap):
+        for observer in self.observers:
+            observer(self, supermap)
+
+    def enable_profiling(self):
+        # times the phases of generate in self.timings (cumulative, the time of a phase doesn't include the phases called from it)
+        # the timed methods are only wrapped while profiling, so it costs nothing when disabled
+        self.timings = {phase: 0.0 for phase in WFC.PROFILED_PHASES.values()}
+        for name, phase in WFC.PROFILED_PHASES.items():
+            setattr(self, name, self._get_timed(getattr(WFC, name).__get__(self), phase))
+
+    def disable_profiling(self):
+        for name in WFC.PROFILED_PHASES:
+            self.__dict__.pop(name, None)
+
+    def _get_timed(self, method, phase):
+        def timed(*args):
+            self._timer_stack.append(0.0) # time of the timed calls inside this one
+            start = time.perf_counter()
+            try:
+                return method(*args)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.timings[phase] += elapsed - self._timer_stack.pop()
+                if len(self._timer_stack) > 0:
+                    self._timer_stack[-1] += elapsed
+        return timed
 
     def _get_updated_possibilities(self, possibilities, collapsed_value, move_number):
-        if possibilities.shape[0] == 1:
-            return possibilities
-        return possibilities[np.array(list(map(lambda p: (collapsed_value, p, move_number) in self.dist.exists, possibilities)))]
+        return possibilities & self.dist.get_compatible(collapsed_value, move_number)
 
     def _get_options(self):
-        return np.array(list(self.dist.unit_numbers), dtype=np.int64)
-        # not int because of possible overflow: OverflowError: Python int too large to convert to C long
-        # https://stackoverflow.com/questions/38314118/overflowerror-python-int-too-large-to-convert-to-c-long-on-windows-but-not-ma
+        return np.ones(len(self.dist.units), dtype=bool)
 
-    def _get_context(self, supermap, unit_number, x, y):
-        context = [unit_number, None, None, None, None]
+    def _get_collapsed_value(self, supermap, x, y):
+        options = np.flatnonzero(supermap[x, y])
+        return options[0] if len(options) == 1 else None
+
+    def _get_context_key(self, supermap, x, y):
+        # unit indices of the collapsed neighbors, None for the unknown ones
+        if supermap is self._supermap:
+            return self._context_keys[x, y]
+        context = [None, None, None, None]
         for k in range(len(ImageDistribution.MOVESET)):
             dx, dy = ImageDistribution.MOVESET[k]
-            if in_bound(x+dx, y+dy, supermap) and len(supermap[x+dx, y+dy]) == 1:
-                context[k+1] = supermap[x+dx, y+dy][0]
-        return (context[0], context[1], context[2], context[3], context[4])
-    
+            if in_bound(x+dx, y+dy, supermap):
+                context[k] = self._get_collapsed_value(supermap, x+dx, y+dy)
+        return (context[0], context[1], context[2], context[3])
+
+    def _get_context_weights(self, supermap, x, y):
+        # weight vectors over all unit indices, shared by the positions with the same context
+        # (least recently used first, the oldest ones are dropped above CONTEXT_WEIGHTS_MEMORY bytes)
+        key = self._get_context_key(supermap, x, y)
+        if key in self._context_weights:
+            self._context_weights.move_to_end(key)
+            return self._context_weights[key]
+        weights = self.dist.get_context_weights(key)
+        self._context_weights[key] = weights
+        while len(self._context_weights) > 1 and len(self._context_weights) * weights.nbytes > WFC.CONTEXT_WEIGHTS_MEMORY:
+            self._context_weights.popitem(last=False)
+        return weights
+
     def _get_weights(self, supermap, x, y):
+        options = np.flatnonzero(supermap[x, y])
         if self.weighting_option == WeightingOptions.TILE_FREQUENCY:
-            return np.array(list(map(lambda u: self.dist.get_unit_frequency(u), supermap[x, y])))
+            return self.dist.get_unit_frequencies()[options]
         elif self.weighting_option == WeightingOptions.UNIFORM:
-            return np.ones(supermap[x, y].shape)
+            return np.ones(options.shape)
         elif self.weighting_option == WeightingOptions.CONTEXT_SENSITIVE:
-            weights = np.array(list(map(lambda u: self.dist.get_context_frequency(self._get_context(supermap, u, x, y)), supermap[x, y])))
+            weights = self._get_context_weights(supermap, x, y)[options]
             if np.sum(weights) == 0:
-                return np.array(list(map(lambda u: self.dist.get_unit_frequency(u), supermap[x, y]))) # fall-back: return frequency weighted
+                return self.dist.get_unit_frequencies()[options] # fall-back: return frequency weighted
             return weights
         raise Exception("weighting option not implemented!")
 
@@ -66,122 +158,606 @@ class WFC:
 
     def _get_entropy(self, supermap, x, y, map_size):
         if self.entropy_option == EntropyOptions.SHANNON:
-            weights = self._get_weights(supermap, x, y)
-            return np.log(np.sum(weights)) - (np.sum(weights * np.log(weights)) / np.sum(weights))
+            # sums are cached per position by _refresh_entropy
+            return np.log(self._weight_sums[x, y]) - (self._weight_log_sums[x, y] / self._weight_sums[x, y])
         elif self.entropy_option == EntropyOptions.NUMBER_OF_OPTIONS:
-            return len(supermap[x, y])
+            return self._counts[x, y]
         elif self.entropy_option == EntropyOptions.TOP_LEFT:
             return x * map_size[1] + y
         elif self.entropy_option == EntropyOptions.TOP_RIGHT:
             return x * map_size[1] + (map_size[0] - y)
         raise Exception("entropy option not implemented!")
 
+    def _init_selection(self, supermap, map_size):
+        self._map_size = map_size
+        self._counts = np.count_nonzero(supermap, axis=2)
+        if self.weighting_option == WeightingOptions.CONTEXT_SENSITIVE:
+            self._context_keys = np.empty(map_size, dtype=object)
+            for i in range(map_size[0]):
+                for j in range(map_size[1]):
+                    self._context_keys[i, j] = self._get_context_key(supermap, i, j)
+            self._supermap = supermap # context keys are kept up to date for this supermap only
+        self._scan_order = None
+        if self.entropy_option in [EntropyOptions.TOP_LEFT, EntropyOptions.TOP_RIGHT]:
+            # the order is fixed, a cursor skipping the collapsed positions is enough
+            order = np.arange(map_size[0] * map_size[1]).reshape(map_size)
+            if self.entropy_option == EntropyOptions.TOP_RIGHT:
+                order = order[:, ::-1]
+            self._scan_order = order.reshape(-1)
+            self._scan_rank = np.argsort(self._scan_order).reshape(map_size)
+            self._cursor = 0
+            return
+        self._weight_sums = np.zeros(map_size)
+        self._weight_log_sums = np.zeros(map_size)
+        self._entropies = np.full(map_size, np.Inf)
+        self._heap = []
+        for i in range(map_size[0]):
+            for j in range(map_size[1]):
+                self._refresh_entropy(supermap, i, j)
+
+    def _refresh_entropy(self, supermap, x, y):
+        if self._counts[x, y] <= 1:
+            self._entropies[x, y] = np.Inf
+            return
+        if self.entropy_option == EntropyOptions.SHANNON:
+            weights = np.asarray(self._get_weights(supermap, x, y), dtype=float)
+            self._weight_sums[x, y] = np.sum(weights)
+            self._weight_log_sums[x, y] = np.sum(weights * np.log(weights, out=np.zeros(weights.shape), where=weights > 0))
+        entropy = self._get_entropy(supermap, x, y, self._map_size)
+        self._entropies[x, y] = entropy
+        heapq.heappush(self._heap, (entropy, x * self._map_size[1] + y))
+
+    def _on_options_changed(self, supermap, x, y):
+        count = np.count_nonzero(supermap[x, y])
+        context_changed = (count <= 1 or self._counts[x, y] <= 1) and supermap is self._supermap
+        self._counts[x, y] = count
+        if context_changed:
+            collapsed_value = self._get_collapsed_value(supermap, x, y)
+            for k in range(len(ImageDistribution.MOVESET)):
+                dx, dy = ImageDistribution.MOVESET[k]
+                if in_bound(x+dx, y+dy, supermap):
+                    key = list(self._context_keys[x+dx, y+dy])
+                    key[self._opposite[k]] = collapsed_value
+                    self._context_keys[x+dx, y+dy] = tuple(key)
+        if self._scan_order is not None:
+            self._cursor = min(self._cursor, self._scan_rank[x, y]) # undone positions can be before the cursor
+            return
+        self._refresh_entropy(supermap, x, y)
+        if context_changed:
+            for dx, dy in ImageDistribution.MOVESET:
+                if in_bound(x+dx, y+dy, supermap):
+                    self._refresh_entropy(supermap, x+dx, y+dy)
+
     def _get_position_to_collapse(self, supermap, map_size):
-        entropies = []
-        for i in range(supermap.shape[0]):
-            for j in range(supermap.shape[1]):
-                entropies.append(self._get_entropy(supermap, i, j, map_size) if len(supermap[i, j]) > 1 else np.Inf)
-        entropies = np.array(entropies)
-        min_entropy = np.argmin(entropies, axis=None)
-        if entropies[min_entropy] == np.Inf:
-            return None, None
-        return np.unravel_index(np.argmin(entropies, axis=None), supermap.shape)
+        if self._scan_order is not None:
+            while self._cursor < len(self._scan_order) and self._counts.flat[self._scan_order[self._cursor]] <= 1:
+                self._cursor += 1
+            if self._cursor == len(self._scan_order):
+                return None, None
+            return np.unravel_index(self._scan_order[self._cursor], self._counts.shape)
+        while len(self._heap) > 0:
+            entropy, index = self._heap[0]
+            if self._entropies.flat[index] == entropy:
+                return np.unravel_index(index, self._counts.shape)
+            heapq.heappop(self._heap) # outdated entry, the position has changed since it was pushed
+        return None, None
+
+    def _choose(self, supermap, x, y):
+        # binary search of a uniform sample in the cumulative weights, zero weights are never chosen
+        cumulative = np.cumsum(self._get_weights(supermap, x, y))
+        index = np.searchsorted(cumulative, self.rng.random() * cumulative[-1], side='right')
+        return np.flatnonzero(supermap[x, y])[min(index, len(cumulative) - 1)]
 
     def _collapse(self, supermap, x, y, map_size):
-        probabilities = self._get_probabilities(supermap, x, y)
-        supermap[x, y] = np.array([np.random.choice(supermap[x, y], p=probabilities)])
+        value = self._choose(supermap, x, y)
+        banned = supermap[x, y].copy()
+        banned[value] = False
+        self._ban(supermap, x, y, banned)
+
+    def _ban(self, supermap, x, y, banned):
+        # every removal of options from the supermap goes through here, banned is a mask or an array of unit indices
+        banned = np.flatnonzero(banned & supermap[x, y]) if banned.dtype == bool else banned[supermap[x, y, banned]]
+        if len(banned) == 0:
+            return
+        supermap[x, y, banned] = False
+        self.stats['removed'] += len(banned)
+        if self._trail is not None:
+            self._trail.append((x, y, banned, False))
+        if self.updating_option == UpdatingOptions.AC4:
+            self._ban_queue.append((x, y, banned))
+            self.stats['queued'] += 1
+        if self._counts is not None:
+            self._on_options_changed(supermap, x, y)
+
+    def _undo(self, supermap, trail_length):
+        # reverts the supermap (and the support counters) to when the trail had trail_length entries
+        while len(self._trail) > trail_length:
+            x, y, banned, supports = self._trail.pop()
+            if supports:
+                self._add_supports(supermap, [(x, y, banned)], 1)
+            else:
+                supermap[x, y, banned] = True
+                self._on_options_changed(supermap, x, y)
+
+    def _get_compatible_units(self, units):
+        # (position in units, move, unit index) of each unit compatible with one of the given units at MOVESET[move] from it,
+        # read from the rows of the distribution's pair CSR without going through the dense propagator
+        n_moves = len(ImageDistribution.MOVESET)
+        rows = (units[:, None] * n_moves + np.arange(n_moves)).reshape(-1)
+        starts = self.dist.pair_indptr[rows]
+        lengths = self.dist.pair_indptr[rows + 1] - starts
+        targets = self.dist.pair_indices[np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())]
+        return np.repeat(np.arange(len(rows)) // n_moves, lengths), np.repeat(rows % n_moves, lengths), targets
+
+    def _add_supports(self, supermap, bans, sign):
+        # units at the neighbors of each (x, y, unit indices) ban gain (or lose) the support they have from the banned units at (x, y)
+        # returns the (x, y, unit index, move to (x, y) from the ban) of the supports which changed, sorted by position
+        units = np.concatenate([banned for _, _, banned in bans])
+        origins, moves, targets = self._get_compatible_units(units)
+        origins = np.repeat(np.arange(len(bans)), [len(banned) for _, _, banned in bans])[origins]
+        xs = np.array([x for x, _, _ in bans])[origins] + self._moves[moves, 0]
+        ys = np.array([y for _, y, _ in bans])[origins] + self._moves[moves, 1]
+        inside = (xs >= 0) & (xs < supermap.shape[0]) & (ys >= 0) & (ys < supermap.shape[1])
+        n_moves, n_units = len(ImageDistribution.MOVESET), supermap.shape[2]
+        # one counter per (neighbor position, move, unit index), summed over the bans at the same position
+        keys, counts = np.unique(((xs[inside] * supermap.shape[1] + ys[inside]) * n_moves + moves[inside]) * n_units + targets[inside],
+                                 return_counts=True)
+        keys, targets = np.divmod(keys, n_units)
+        keys, moves = np.divmod(keys, n_moves)
+        xs, ys = np.divmod(keys, supermap.shape[1])
+        self._supports[xs, ys, targets, self._opposite[moves]] += (sign * counts).astype(self._supports.dtype)
+        return xs, ys, targets, moves
+
+    def _get_initial_supports(self, supermap):
+        # _supports[x, y, u, k]: number of options at (x, y)+MOVESET[k] that unit u is compatible with
+        n_units = supermap.shape[2]
+        dtype = np.int16 if n_units < np.iinfo(np.int16).max else np.int32
+        supports = np.empty(supermap.shape + (len(ImageDistribution.MOVESET),), dtype=dtype)
+        supports[:, :] = np.count_nonzero(self.dist.propagator, axis=2).T
+        for k in range(len(ImageDistribution.MOVESET)):
+            dx, dy = ImageDistribution.MOVESET[k]
+            # out of bound neighbors never run out of support
+            if dx != 0:
+                supports[-1 if dx > 0 else 0, :, :, k] = n_units + 1
+            if dy != 0:
+                supports[:, -1 if dy > 0 else 0, :, k] = n_units + 1
+        return supports
+
+    def _update_supports(self, supermap):
+        invalid = False
+        while len(self._ban_queue) > 0:
+            # the queued bans are propagated together, AC4 reaches the same supermap in any order
+            bans = []
+            while len(self._ban_queue) > 0:
+                x, y, banned = self._ban_queue.popleft()
+                if supermap[x, y].any(): # otherwise a contradiction, leave the hole unconstrained instead of wiping its neighbors
+                    bans.append((x, y, banned))
+            if len(bans) == 0:
+                break
+            self.stats['propagations'] += len(bans)
+            xs, ys, targets, moves = self._add_supports(supermap, bans, -1)
+            if self._trail is not None:
+                self._trail.extend((x, y, banned, True) for x, y, banned in bans)
+            # only the units which just lost support can run out of it
+            unsupported = supermap[xs, ys, targets] & (self._supports[xs, ys, targets, self._opposite[moves]] <= 0)
+            xs, ys, targets = xs[unsupported], ys[unsupported], targets[unsupported]
+            positions, starts = np.unique(xs * supermap.shape[1] + ys, return_index=True)
+            for position, start, end in zip(positions.tolist(), starts.tolist(), starts[1:].tolist() + [len(targets)]):
+                x, y = divmod(position, supermap.shape[1])
+                self._ban(supermap, x, y, np.unique(targets[start:end]))
+                if not supermap[x, y].any():
+                    self.stats['contradictions'] += 1
+                    invalid = True
+        return not invalid
 
     def _update_supermap(self, changed_x, changed_y, supermap):
-        changed_queue = [(changed_x, changed_y)]
+        return self._update_supermap_from([(changed_x, changed_y)], supermap)
+
+    def _update_supermap_from(self, changed_positions, supermap):
+        # one propagation pass starting from all of the changed positions
+        if self.updating_option == UpdatingOptions.AC4:
+            return self._update_supports(supermap)
+        changed_queue = deque(changed_positions)
+        self.stats['queued'] += len(changed_queue)
         invalid = False
         while len(changed_queue) > 0:
-            x, y = changed_queue[0]
-            changed_queue = changed_queue[1:]
-            if len(supermap[x, y]) != 1:
+            x, y = changed_queue.popleft()
+            collapsed_value = self._get_collapsed_value(supermap, x, y)
+            if collapsed_value is None:
                 continue # TODO WHY? -> because we need the collapsed value to get possibilities
+            self.stats['propagations'] += 1
             for k in range(len(ImageDistribution.MOVESET)):
                 dx, dy = ImageDistribution.MOVESET[k]
-                if in_bound(x+dx, y+dy, supermap) and len(supermap[x+dx, y+dy]) > 1:
-                    new_possibilities = self._get_updated_possibilities(supermap[x+dx, y+dy], supermap[x, y][0], k)
-                    if len(new_possibilities) != len(supermap[x+dx, y+dy]):
-                        supermap[x+dx, y+dy] = new_possibilities
-                        if len(new_possibilities) < 1:
+                if in_bound(x+dx, y+dy, supermap) and np.count_nonzero(supermap[x+dx, y+dy]) > 1:
+                    new_possibilities = self._get_updated_possibilities(supermap[x+dx, y+dy], collapsed_value, k)
+                    if not np.array_equal(new_possibilities, supermap[x+dx, y+dy]):
+                        self._ban(supermap, x+dx, y+dy, supermap[x+dx, y+dy] & ~new_possibilities)
+                        if not new_possibilities.any():
+                            self.stats['contradictions'] += 1
                             invalid = True
                         if self.updating_option == UpdatingOptions.NEIGHBOR:
                             pass
                         elif self.updating_option == UpdatingOptions.CHAIN:
                             changed_queue.append((x+dx, y+dy))
+                            self.stats['queued'] += 1
         return not invalid
 
+    def _get_pinned_units(self, map_size, existing_tiles):
+        # (map_size) array of the unit index pinned at each position, -1 where nothing is pinned
+        # and the positions of the existing tiles that can't be placed together
+        pinned = np.full(map_size, -1, dtype=np.int64)
+        conflicting = np.zeros(map_size, dtype=bool)
+        if len(existing_tiles) == 0:
+            return pinned, []
+        xs, ys = np.array([existing_tile.pos for existing_tile in existing_tiles]).T
+        units = np.array([self.dist.unit_index.get(existing_tile.tile_number, -1) for existing_tile in existing_tiles])
+        pinned[xs, ys] = units
+        # different units at the same position: compared with the first one at their position
+        _, first, inverse = np.unique(xs * map_size[1] + ys, return_index=True, return_inverse=True)
+        different = units != units[first][inverse.reshape(-1)]
+        conflicting[xs[different], ys[different]] = True
+        conflicting[xs[units < 0], ys[units < 0]] = True # unknown units
+        for k in range(len(ImageDistribution.MOVESET)):
+            dx, dy = ImageDistribution.MOVESET[k]
+            # pinned positions whose pinned neighbor at MOVESET[k] is not compatible with them
+            source = pinned[max(-dx, 0):map_size[0] - max(dx, 0), max(-dy, 0):map_size[1] - max(dy, 0)]
+            target = pinned[max(dx, 0):map_size[0] + min(dx, 0), max(dy, 0):map_size[1] + min(dy, 0)]
+            both = (source >= 0) & (target >= 0)
+            incompatible = np.zeros(source.shape, dtype=bool)
+            incompatible[both] = ~self.dist.propagator[k, source[both], target[both]]
+            conflicting[max(-dx, 0):map_size[0] - max(dx, 0), max(-dy, 0):map_size[1] - max(dy, 0)] |= incompatible
+            conflicting[max(dx, 0):map_size[0] + min(dx, 0), max(dy, 0):map_size[1] + min(dy, 0)] |= incompatible
+        return pinned, [(int(x), int(y)) for x, y in zip(*np.nonzero(conflicting))]
+
+    def get_conflicting_tiles(self, map_size, existing_tiles):
+        # positions of the existing tiles that can't be placed together (unknown units, different units at the same position,
+        # incompatible neighbors, or removed or leaving positions without options when propagated), without generating
+        try:
+            self._get_initial_supermap(map_size, existing_tiles)
+        except Exception:
+            pass
+        return self.conflicting_tiles
+
     def _get_initial_supermap(self, map_size, existing_tiles):
         options = self._get_options()
-        supermap = np.array([[None for _ in range(map_size[1])] for _ in range(map_size[0])], dtype=object)
-        for i in range(map_size[0]):
-            for j in range(map_size[1]):
-                supermap[i, j] = options.copy()
-        for existing_tile in existing_tiles:
-            i, j = existing_tile.pos
-            supermap[i, j] = np.array([existing_tile.tile_number])
-            self._update_supermap(i, j, supermap)
+        supermap = np.empty((map_size[0], map_size[1], options.shape[0]), dtype=bool)
+        supermap[:, :] = options
+        self._ban_queue.clear()
+        self._counts = None
+        self._trail = None
+        self._supermap = None
+        self._context_weights = OrderedDict()
+        pinned, self.conflicting_tiles = self._get_pinned_units(map_size, existing_tiles)
+        if len(self.conflicting_tiles) > 0:
+            raise Exception('Conflicting existing tiles at {}'.format(self.conflicting_tiles))
+        # all of the existing tiles are placed at once, then propagated in a single pass
+        xs, ys = np.nonzero(pinned >= 0)
+        units = pinned[xs, ys]
+        supermap[xs, ys] = False
+        supermap[xs, ys, units] = True
+        if self.updating_option == UpdatingOptions.AC4:
+            self._supports = self._get_initial_supports(supermap)
+            for k in range(len(ImageDistribution.MOVESET)):
+                dx, dy = ImageDistribution.MOVESET[k]
+                # the neighbor at MOVESET[k] is pinned, only the pinned unit supports the options
+                inside = (xs - dx >= 0) & (xs - dx < map_size[0]) & (ys - dy >= 0) & (ys - dy < map_size[1])
+                self._supports[xs[inside] - dx, ys[inside] - dy, :, k] = self.dist.propagator[self._opposite[k], units[inside]]
+            unsupported = supermap & np.any(self._supports <= 0, axis=3)
+            for i, j in zip(*np.nonzero(unsupported.any(axis=2))):
+                self._ban(supermap, i, j, unsupported[i, j])
+        self._update_supermap_from(list(zip(xs, ys)), supermap)
+        # existing tiles which are removed by the propagation of the others, or which together leave a position without options
+        self.conflicting_tiles = [(int(x), int(y)) for x, y in zip(xs, ys) if not supermap[x, y].any()]
+        if len(self.conflicting_tiles) == 0 and len(xs) > 0 and not supermap.any(axis=2).all():
+            self.conflicting_tiles = self._get_emptying_tiles(map_size, supermap, pinned)
+        if len(self.conflicting_tiles) > 0:
+            raise Exception('Conflicting existing tiles at {}'.format(self.conflicting_tiles))
+        self._init_selection(supermap, map_size)
         return supermap
 
-    def generate_bt(self, map_size, existing_tiles=[], gif_maker=None):
-        self._bt_counter = 0
+    def _get_emptying_tiles(self, map_size, supermap, pinned):
+        # existing tiles whose propagation reached the positions left without options: the pinned positions connected to them
+        # through positions which have fewer options than without the existing tiles (replaces the initial state, only used before raising)
+        unpinned = self._get_initial_supermap(map_size, [])
+        changed = (supermap != unpinned).any(axis=2)
+        reached = changed & ~supermap.any(axis=2)
+        queue = deque(zip(*np.nonzero(reached)))
+        while len(queue) > 0:
+            x, y = queue.popleft()
+            for dx, dy in ImageDistribution.MOVESET:
+                if in_bound(x+dx, y+dy, supermap) and changed[x+dx, y+dy] and not reached[x+dx, y+dy]:
+                    reached[x+dx, y+dy] = True
+                    queue.append((x+dx, y+dy))
+        return [(int(x), int(y)) for x, y in zip(*np.nonzero(reached & (pinned >= 0)))]
+
+    def _get_generated_map(self, supermap):
+        map = np.empty(supermap.shape[:2], dtype=object)
+        for i in range(supermap.shape[0]):
+            for j in range(supermap.shape[1]):
+                options = np.flatnonzero(supermap[i, j])
+                map[i, j] = self.dist.units[options[0]] if len(options) > 0 else None
+        return map
+
+    def _get_conflicts(self, supermap, levels, level):
+        # decision levels that removed options around the positions the failed attempt of level depended on
+        positions = {(level[1], level[2])}
+        for x, y, _, _ in self._trail[level[0]:]:
+            positions.add((x, y))
+            for dx, dy in ImageDistribution.MOVESET:
+                positions.add((x+dx, y+dy))
+        starts = [l[0] for l in levels]
+        conflicts = set()
+        for i in range(level[0]):
+            x, y, _, _ = self._trail[i]
+            if (x, y) in positions:
+                conflicts.add(bisect.bisect_right(starts, i) - 1)
+        conflicts.discard(-1) # bans from before the first decision
+        return conflicts
+
+    def _search_bt(self, map_size, existing_tiles, run_limit, backtrack_limit, deadline, backjump):
+        # one run of backtracking search, returns the final supermap and decision levels or None after run_limit backtracks
         supermap = self._get_initial_supermap(map_size, existing_tiles)
-        tested = np.array([[None for _ in range(map_size[1])] for _ in range(map_size[0])], dtype=object)
-        for i in range(map_size[0]):
-            for j in range(map_size[1]):
-                tested[i, j] = []
-        checkpoints = [(supermap.copy(), tested.copy())]
+        self._notify(supermap)
+        self._trail = []
+        # one decision level per collapsed position: [trail length before the collapse, x, y, tested unit indices, conflicting levels]
+        levels = []
+        level = None # set when a level is tried again after backtracking
+        run_backtracks = 0
         while True:
-            if len(checkpoints) == 0:
-                raise Exception('Not possible')
-            # copy supermap and tested
-            supermap, tested = checkpoints[-1]
-            supermap, tested = supermap.copy(), tested.copy() # TODO deep copy supermap (not really needed)
-            for i in range(map_size[0]):
-                for j in range(map_size[1]):
-                    tested[i, j] = [val for val in tested[i, j]]
-            # find position to collapse
-            x, y = self._get_position_to_collapse(supermap, map_size) # why not remove tested: because then maybe len == 1 for some positions
-            if x is None or y is None:
-               break
+            if self.stats['backtracks'] >= backtrack_limit or time.perf_counter() > deadline:
+                raise Exception('Backtracking budget exceeded')
+            if run_backtracks >= run_limit:
+                return None
+            if level is None:
+                # find position to collapse
+                x, y = self._get_position_to_collapse(supermap, map_size)
+                if x is None or y is None:
+                   break
+                level = [len(self._trail), x, y, [], set()]
+            _, x, y, tested, conflicts = level
             #use untested ones at [x, y] to collapse(x, y)
-            options = supermap.copy()
-            options[x, y] = np.delete(options[x, y], np.where(np.in1d(options[x, y], tested[x, y])))
-            if len(options[x, y]) == 0:
-                checkpoints = checkpoints[:-1]
+            options = supermap[x, y].copy()
+            options[tested] = False
+            if not options.any():
+                if backjump:
+                    if len(conflicts) == 0:
+                        raise Exception('Not possible')
+                    depth = max(conflicts)
+                    self.stats['backjumps'] += len(levels) - 1 - depth
+                    levels = levels[:depth + 1]
+                    levels[-1][4] |= conflicts - {depth}
+                elif len(levels) == 0:
+                    raise Exception('Not possible')
+                level = levels.pop()
+                self._undo(supermap, level[0])
+                self.stats['backtracks'] += 1
+                run_backtracks += 1
                 continue
-            if len(options[x, y]) > 1:
-                self._collapse(options, x, y, map_size)
-            supermap[x, y] = options[x, y]
-            #update tested
-            tested[x, y].append(supermap[x, y][0])
-            checkpoints[-1][1][x, y].append(supermap[x, y][0])
+            if np.count_nonzero(options) > 1:
+                current = supermap[x, y].copy()
+                supermap[x, y] = options # temporarily restrict the position to the untested options
+                value = self._choose(supermap, x, y)
+                supermap[x, y] = current
+            else:
+                value = np.flatnonzero(options)[0]
+            tested.append(value)
+            banned = supermap[x, y].copy()
+            banned[value] = False
+            self._ban(supermap, x, y, banned)
             if self._update_supermap(x, y, supermap):
-                # checkpoint
-                checkpoints.append((supermap, tested))
+                levels.append(level)
+                level = None
+            else:
+                self._ban_queue.clear()
+                if backjump:
+                    conflicts |= self._get_conflicts(supermap, levels, level)
+                self._undo(supermap, level[0])
+                self.stats['backtracks'] += 1
+                run_backtracks += 1
             self._bt_counter += 1
+            self.stats['steps'] = self._bt_counter
+            self._notify(supermap)
+        return supermap, levels
+
+    def generate_bt(self, map_size, existing_tiles=[], gif_maker=None, max_backtracks=None, time_budget=None,
+                    restart_option=RestartOptions.NONE, restart_base=100, restart_factor=2, backjump=False):
+        # max_backtracks and time_budget (seconds) bound the whole search, including restarts
+        # backjump jumps back to the latest decision that removed options around the contradiction, instead of the previous one
+        self._bt_counter = 0
+        self._reset_stats()
+        backtrack_limit = np.Inf if max_backtracks is None else max_backtracks
+        deadline = np.Inf if time_budget is None else time.perf_counter() + time_budget
+        result = None
+        while result is None:
+            run = self.stats['restarts']
+            if restart_option == RestartOptions.LUBY:
+                run_limit = restart_base * luby(run + 1)
+            elif restart_option == RestartOptions.GEOMETRIC:
+                run_limit = restart_base * restart_factor ** run
+            elif restart_option == RestartOptions.NONE:
+                run_limit = np.Inf
+            else:
+                raise Exception("restart option not implemented!")
+            try:
+                # a new run continues the random stream, so it makes different (but reproducible) decisions
+                result = self._search_bt(map_size, existing_tiles, run_limit, backtrack_limit, deadline, backjump)
+            finally:
+                if result is None:
+                    self._trail = None
+            if result is None:
+                self.stats['restarts'] += 1
+        supermap, levels = result
         if gif_maker is not None:
-            for checkpoint in checkpoints:
-                c_supermap, _ = checkpoint
-                gif_maker.add_frame(c_supermap)
-            gif_maker.add_frame(supermap)
-        map = np.array([[possibilities[0] if len(possibilities) > 0 else None for possibilities in row] for row in supermap])
-        return map
+            # the observers see the backtracked steps too, the gif only shows the decisions that led to the output:
+            # replay the trail backwards to get the supermap before each decision
+            frames = [supermap.copy()]
+            replay = supermap.copy()
+            for trail_length, _, _, _, _ in reversed(levels):
+                while len(self._trail) > trail_length:
+                    x, y, banned, supports = self._trail.pop()
+                    if not supports:
+                        replay[x, y, banned] = True
+                frames.append(replay.copy())
+            for frame in reversed(frames):
+                gif_maker.add_frame(frame)
+        self._trail = None
+        return self._get_generated_map(supermap)
 
-    def generate(self, map_size, seed=0, existing_tiles=[], backtrack=False, gif_maker=None):
-        np.random.seed(seed)
+    def generate(self, map_size, seed=0, existing_tiles=[], backtrack=False, gif_maker=None, **backtrack_options):
+        # backtrack_options are passed to generate_bt (budgets, restarts and backjumping)
+        # without backtracking gif_maker is an observer of this call, see add_observer
+        self.rng = np.random.Generator(np.random.PCG64(seed))
+        self._reset_stats()
         if backtrack:
-            return self.generate_bt(map_size, existing_tiles, gif_maker)
-        supermap = self._get_initial_supermap(map_size, existing_tiles)
-        if gif_maker is not None: gif_maker.add_frame(supermap)
-        while True:
-            x, y = self._get_position_to_collapse(supermap, map_size)
-            if x is None or y is None:
-                break
-            self._collapse(supermap, x, y, map_size)
-            self._update_supermap(x, y, supermap)
-            if gif_maker is not None: gif_maker.add_frame(supermap)
-        map = np.array([[possibilities[0] if len(possibilities) > 0 else None for possibilities in row] for row in supermap])
-        return map
\ No newline at end of file
+            return self.generate_bt(map_size, existing_tiles, gif_maker, **backtrack_options)
+        if gif_maker is not None:
+            self.add_observer(gif_maker)
+        try:
+            supermap = self._get_initial_supermap(map_size, existing_tiles)
+            self._notify(supermap)
+            while True:
+                x, y = self._get_position_to_collapse(supermap, map_size)
+                if x is None or y is None:
+                    break
+                self._collapse(supermap, x, y, map_size)
+                self._update_supermap(x, y, supermap)
+                self.stats['steps'] += 1
+                self._notify(supermap)
+        finally:
+            if gif_maker is not None:
+                self.remove_observer(gif_maker)
+        return self._get_generated_map(supermap)
+
+    def _solve_chunk(self, region_size, pins, seed, backtrack, backtrack_options):
+        # returns the generated region, or None if it could not be solved with the pinned positions
+        try:
+            generated = self.generate(region_size, seed, pins, backtrack, **backtrack_options)
+        except Exception:
+            return None
+        return generated
+
+    def generate_chunked(self, map_size, chunk_size, seed=0, existing_tiles=[], overlap=2, backtrack=False,
+                         max_workers=1, max_attempts=3, **backtrack_options):
+        # generates the map chunk by chunk, so only a chunk sized supermap is held at a time
+        # each chunk is solved with `overlap` positions of its neighbors around it, and the positions of that region which are
+        # already decided (borders of the solved neighbors and existing_tiles) are pinned as existing tiles
+        # chunks are solved in the four phases of a checkerboard, the chunks of a phase don't touch each other and
+        # are solved in parallel by max_workers processes (None for one per core, 1 to solve them in this process)
+        # a chunk which can't be solved is solved again, each attempt also re-solving `overlap` more of the decided positions around it
+        map = np.full(map_size, None, dtype=object)
+        decided = np.zeros(map_size, dtype=bool)
+        fixed = np.zeros(map_size, dtype=bool) # existing tiles are never solved again
+        for existing_tile in existing_tiles:
+            map[existing_tile.pos] = existing_tile.tile_number
+            decided[existing_tile.pos] = fixed[existing_tile.pos] = True
+        rows = -(-map_size[0] // chunk_size[0])
+        cols = -(-map_size[1] // chunk_size[1])
+
+        def get_task(ci, cj, attempt):
+            free = attempt * overlap # decided positions this close to the chunk are solved again
+            x0, y0 = max(ci * chunk_size[0] - free - overlap, 0), max(cj * chunk_size[1] - free - overlap, 0)
+            x1 = min((ci + 1) * chunk_size[0] + free + overlap, map_size[0])
+            y1 = min((cj + 1) * chunk_size[1] + free + overlap, map_size[1])
+            keep = decided.copy()
+            keep[max(ci * chunk_size[0] - free, 0):(ci + 1) * chunk_size[0] + free,
+                 max(cj * chunk_size[1] - free, 0):(cj + 1) * chunk_size[1] + free] = False
+            keep |= fixed
+            pins = [ExistingTile((i, j), map[x0 + i, y0 + j]) for i, j in zip(*np.nonzero(keep[x0:x1, y0:y1]))]
+            return (x1 - x0, y1 - y0), pins, get_seed(seed, ci, cj, attempt), backtrack, backtrack_options
+
+        def commit(ci, cj, attempt, generated):
+            free = attempt * overlap
+            x0, y0 = max(ci * chunk_size[0] - free - overlap, 0), max(cj * chunk_size[1] - free - overlap, 0)
+            i0, j0 = max(ci * chunk_size[0] - free, 0), max(cj * chunk_size[1] - free, 0)
+            i1, j1 = min((ci + 1) * chunk_size[0] + free, map_size[0]), min((cj + 1) * chunk_size[1] + free, map_size[1])
+            map[i0:i1, j0:j1] = generated[i0 - x0:i1 - x0, j0 - y0:j1 - y0]
+            decided[i0:i1, j0:j1] = map[i0:i1, j0:j1] != None
+
+        def is_solved(generated):
+            return generated is not None and all(unit is not None for unit in generated.flat)
+
+        executor = None
+        if max_workers != 1:
+            init_args = (self.dist.to_arrays(), self.weighting_option, self.updating_option, self.entropy_option)
+            executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=init_args)
+        try:
+            for phase_i, phase_j in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+                chunks = [(ci, cj) for ci in range(phase_i, rows, 2) for cj in range(phase_j, cols, 2)]
+                tasks = [get_task(ci, cj, 0) for ci, cj in chunks]
+                if executor is None:
+                    results = [self._solve_chunk(*task) for task in tasks]
+                else:
+                    results = executor.map(_solve_chunk_in_worker, tasks)
+                failed = []
+                for (ci, cj), generated in zip(chunks, results):
+                    if is_solved(generated):
+                        commit(ci, cj, 0, generated)
+                    else:
+                        failed.append((ci, cj))
+                # solving again changes the decided positions around the chunk, so these are solved one at a time
+                for ci, cj in failed:
+                    for attempt in range(1, max_attempts + 1):
+                        generated = self._solve_chunk(*get_task(ci, cj, attempt))
+                        if is_solved(generated):
+                            break
+                    if generated is None or (backtrack and not is_solved(generated)):
+                        raise Exception('Not possible')
+                    commit(ci, cj, attempt, generated)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return map
+
+_worker_wfc = None # the solver of each worker process of generate_many and generate_chunked
+_worker_wfcs = {} # (weighting_option, updating_option, entropy_option) -> solver of each worker process of generate_configurations
+
+def _init_worker(dist_arrays, weighting_option=None, updating_option=None, entropy_option=None):
+    global _worker_wfc
+    _worker_wfc = WFC(ImageDistribution.from_arrays(dist_arrays), weighting_option, updating_option, entropy_option)
+    _worker_wfcs.clear()
+
+def _solve_chunk_in_worker(task):
+    return _worker_wfc._solve_chunk(*task)
+
+def _generate_in_worker(map_size, seed, existing_tiles, backtrack, backtrack_options):
+    return _worker_wfc.generate(map_size, seed, existing_tiles, backtrack, **backtrack_options)
+
+def generate_many(dist: ImageDistribution, seeds, map_size, weighting_option, updating_option, entropy_option,
+                  existing_tiles=[], backtrack=False, max_workers=None, **backtrack_options):
+    # generates one map per (seed, map size) pair in a pool of processes, yielding (seed, map_size, generated map) as they finish
+    # map_size can be a single size or a list of sizes
+    # the distribution is sent once to each worker, and each map only depends on its seed (through the solver's own generator),
+    # so the outputs don't depend on the scheduling
+    map_sizes = [tuple(map_size)] if np.isscalar(map_size[0]) else [tuple(size) for size in map_size]
+    init_args = (dist.to_arrays(), weighting_option, updating_option, entropy_option)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=init_args) as executor:
+        futures = {}
+        for size in map_sizes:
+            for seed in seeds:
+                future = executor.submit(_generate_in_worker, size, seed, existing_tiles, backtrack, backtrack_options)
+                futures[future] = (seed, size)
+        for future in as_completed(futures):
+            seed, size = futures.pop(future)
+            yield seed, size, future.result()
+
+def _generate_configuration_in_worker(configuration, map_size, seed, existing_tiles, backtrack_options):
+    weighting_option, entropy_option, updating_option, backtrack = configuration
+    options = (weighting_option, updating_option, entropy_option)
+    if options not in _worker_wfcs:
+        _worker_wfcs[options] = WFC(_worker_wfc.dist, *options) # all solvers of the worker share its distribution
+    return _worker_wfcs[options].generate(map_size, seed, existing_tiles, backtrack, **backtrack_options)
+
+def generate_configurations(dist: ImageDistribution, configurations, seeds, map_size, existing_tiles=[], max_workers=None, **backtrack_options):
+    # generates one map per (configuration, seed) pair in a pool of processes, yielding (configuration, seed, generated map) as they finish
+    # each configuration is a (weighting_option, entropy_option, updating_option, backtrack) tuple, and all of them share the distribution
+    # sent once to each worker
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(dist.to_arrays(),)) as executor:
+        futures = {}
+        for configuration in configurations:
+            for seed in seeds:
+                future = executor.submit(_generate_configuration_in_worker, tuple(configuration), map_size, seed,
+                                         existing_tiles, backtrack_options)
+                futures[future] = (configuration, seed)
+        for future in as_completed(futures):
+            configuration, seed = futures.pop(future)
+            yield configuration, seed, future.result()
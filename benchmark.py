@@ -0,0 +1,224 @@
+import csv
+import json
+import time
+import argparse
+import tracemalloc
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from tiled_image import TiledImage, TileGenerator, nxmPatternGenerator, UpLeftLPatternGenerator
+from image_distribution import ImageDistribution
+from WFC import WFC, WeightingOptions, EntropyOptions, UpdatingOptions
+from main import get_stick_data, get_image_data, get_trained
+
+def _time_training(tiled_image, vectorized, repeat):
+    ImageDistribution.VECTORIZED_TRAINING = vectorized
+    times = []
+    for _ in range(repeat):
+        dist = ImageDistribution()
+        start = time.perf_counter()
+        dist.train(tiled_image)
+        times.append(time.perf_counter() - start)
+    return min(times), dist
+
+def benchmark_training(tiled_image, repeat=3):
+    # compares the loop based training with the vectorized one, on the same tiled image
+    default = ImageDistribution.VECTORIZED_TRAINING
+    try:
+        loop_time, loop_dist = _time_training(tiled_image, False, repeat)
+        vectorized_time, vectorized_dist = _time_training(tiled_image, True, repeat)
+    finally:
+        ImageDistribution.VECTORIZED_TRAINING = default
+    same = all(getattr(loop_dist, attr) == getattr(vectorized_dist, attr)
+               for attr in ['unit_frequency', 'pair_frequency', 'pair_dir_frequency', 'context_frequency', 'exists'])
+    return {'units': len(loop_dist.units), 'loop': loop_time, 'vectorized': vectorized_time, 'same': same}
+
+def benchmark_extraction(get_unit_generator, repeat=3):
+    # compares extracting the units one by one with get_next and all at once with get_all
+    default = TiledImage.BULK_EXTRACTION
+    times = {}
+    try:
+        for name, bulk in [('loop', False), ('bulk', True)]:
+            TiledImage.BULK_EXTRACTION = bulk
+            times[name] = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                tiled_image = TiledImage.from_unit_generator(get_unit_generator())
+                times[name].append(time.perf_counter() - start)
+    finally:
+        TiledImage.BULK_EXTRACTION = default
+    return {'units': len(tiled_image.number_to_unit), 'loop': min(times['loop']), 'bulk': min(times['bulk'])}
+
+def benchmark_sorted_views(tiled_image, k=10, repeat=3):
+    # training and then building every *_sorted list (eager) against training alone (lazy, the lists are built when accessed),
+    # and the k most frequent contexts from context_frequency_sorted against get_top_context_frequency
+    def train(eager):
+        dist = ImageDistribution()
+        dist.train(tiled_image)
+        if eager:
+            for name in ['unit_frequency_sorted', 'pair_frequency_sorted', 'pair_dir_frequency_sorted', 'context_frequency_sorted']:
+                getattr(dist, name)
+        return dist
+    def top(dist, sort):
+        dist._derived = {}
+        return dist.context_frequency_sorted[:k] if sort else dist.get_top_context_frequency(k)
+    result = {}
+    for name, eager in [('eager', True), ('lazy', False)]:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            dist = train(eager)
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        dist = train(eager)
+        result[name] = min(times)
+        result[name + '_memory'], result[name + '_peak'] = tracemalloc.get_traced_memory() # bytes kept by the distribution, and at the peak
+        tracemalloc.stop()
+    for name, sort in [('sorted', True), ('top', False)]:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result[name + '_items'] = top(dist, sort)
+            times.append(time.perf_counter() - start)
+        result[name] = min(times)
+    result['same'] = result.pop('sorted_items') == result.pop('top_items')
+    return result
+
+def get_training_inputs(image_filename='zeldaMap.png', tile_size=(16, 16)):
+    image_data = get_image_data(image_filename)
+    return {
+        'stick tiles': lambda: TileGenerator(get_stick_data(), (1, 1)),
+        'tiles': lambda: TileGenerator(image_data, tile_size),
+        '3x3 patterns': lambda: nxmPatternGenerator(image_data, tile_size, 3, 3),
+        'L patterns': lambda: UpLeftLPatternGenerator(image_data, tile_size, 3, 3),
+    }
+
+def get_option_names(options) -> dict:
+    # option value -> name, e.g. {1: 'UNIFORM', 2: 'TILE_FREQUENCY', 3: 'CONTEXT_SENSITIVE'}
+    return {value: name for name, value in vars(options).items() if name.isupper()}
+
+def benchmark_generation(dist_arrays, units, weighting_option, entropy_option, updating_option, backtrack, map_size, seeds, time_budget=None):
+    # generates one map per seed with the given options, returns the averages over the seeds
+    # (run in a new process by run_generation_benchmarks, with the distribution trained in the parent)
+    dist = ImageDistribution.from_arrays(dist_arrays)
+    dist.propagator # derived tables are part of the distribution, not of the generation
+    wfc = WFC(dist, weighting_option, updating_option, entropy_option)
+    totals = {'time': 0, 'steps': 0, 'propagations': 0, 'backtracks': 0, 'contradictions': 0}
+    failed = 0
+    for seed in seeds:
+        start = time.perf_counter()
+        try:
+            generated = wfc.generate(map_size, seed=seed, backtrack=backtrack, time_budget=time_budget)
+            failed += any(unit is None for unit in generated.flat)
+        except Exception:
+            failed += 1 # not possible or out of budget
+        totals['time'] += time.perf_counter() - start
+        for name in ['steps', 'propagations', 'backtracks', 'contradictions']:
+            totals[name] += wfc.stats[name]
+    result = {
+        'units': units, 'n_units': len(dist.units),
+        'weighting': get_option_names(WeightingOptions)[weighting_option],
+        'entropy': get_option_names(EntropyOptions)[entropy_option],
+        'updating': get_option_names(UpdatingOptions)[updating_option],
+        'backtrack': backtrack, 'map_size': '{}x{}'.format(*map_size), 'seeds': len(seeds),
+    }
+    result.update({name: total / len(seeds) for name, total in totals.items()})
+    result['contradiction_rate'] = failed / len(seeds) # runs which left empty positions or failed
+    # the peak of the memory allocated while generating, in a second pass so the tracing doesn't slow the timed one down
+    # (ru_maxrss can't be used: it is the peak of the whole process, which includes the training of the parent on linux)
+    tracemalloc.start()
+    for seed in seeds:
+        try:
+            wfc.generate(map_size, seed=seed, backtrack=backtrack, time_budget=time_budget)
+        except Exception:
+            pass
+    result['peak_memory'] = tracemalloc.get_traced_memory()[1] # bytes
+    tracemalloc.stop()
+    return result
+
+def run_generation_benchmarks(image_filename='zeldaMap.png', tile_size=(16, 16), units=None, weighting_options=None,
+                              entropy_options=None, updating_options=None, backtracks=(False, True),
+                              map_sizes=((10, 10), (20, 20)), seeds=(0, 1, 2), time_budget=30):
+    # every combination of the given options (all of them by default), each in a new (spawned, not forked) process
+    inputs = get_training_inputs(image_filename, tile_size)
+    units = list(inputs) if units is None else units
+    weighting_options = list(get_option_names(WeightingOptions)) if weighting_options is None else weighting_options
+    entropy_options = list(get_option_names(EntropyOptions)) if entropy_options is None else entropy_options
+    updating_options = list(get_option_names(UpdatingOptions)) if updating_options is None else updating_options
+    context = multiprocessing.get_context('spawn')
+    for unit_name in units:
+        dist_arrays = get_trained(inputs[unit_name]())[1].to_arrays()
+        for configuration in itertools.product(weighting_options, entropy_options, updating_options, backtracks, map_sizes):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                yield executor.submit(benchmark_generation, dist_arrays, unit_name, *configuration, seeds, time_budget).result()
+
+def write_results(results, json_filename=None, csv_filename=None):
+    if json_filename is not None:
+        with open(json_filename, 'w') as f:
+            json.dump(results, f, indent=1)
+    if csv_filename is not None and len(results) > 0:
+        with open(csv_filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+
+def main_generation(args):
+    def get_values(names, options):
+        return None if names is None else [getattr(options, name) for name in names]
+    results = []
+    for result in run_generation_benchmarks(args.image, tuple(args.tile_size), args.units,
+                                            get_values(args.weighting, WeightingOptions), get_values(args.entropy, EntropyOptions),
+                                            get_values(args.updating, UpdatingOptions), [bool(b) for b in args.backtrack],
+                                            [(size, size) for size in args.sizes], list(range(args.seeds)), args.time_budget):
+        results.append(result)
+        print(f"{result['units']:>12} {result['weighting']:>17} {result['entropy']:>9} {result['updating']:>8} "
+              f"bt={result['backtrack']:d} {result['map_size']:>7}: {result['time']:7.3f}s, {result['peak_memory'] / 2**20:6.1f}MB, "
+              f"{result['propagations']:9.0f} propagations, {result['backtracks']:7.1f} backtracks, "
+              f"contradiction rate {result['contradiction_rate']:.2f}", flush=True)
+    write_results(results, args.json, args.csv)
+
+def main_training(args):
+    print("extraction: loop vs bulk")
+    for name, unit_generator in get_training_inputs(args.image, tuple(args.tile_size)).items():
+        result = benchmark_extraction(unit_generator, args.repeat)
+        print(f"{name:>14}: {result['units']:5d} units, loop {result['loop']:.3f}s, bulk {result['bulk']:.3f}s "
+              f"({result['loop'] / result['bulk']:.1f}x)")
+    print("training: loop vs vectorized")
+    for name, unit_generator in get_training_inputs(args.image, tuple(args.tile_size)).items():
+        result = benchmark_training(TiledImage.from_unit_generator(unit_generator()), args.repeat)
+        print(f"{name:>14}: {result['units']:5d} units, loop {result['loop']:.3f}s, vectorized {result['vectorized']:.3f}s "
+              f"({result['loop'] / result['vectorized']:.1f}x), same tables: {result['same']}")
+    print("sorted views: eager vs lazy training, full sort vs top 10 contexts")
+    for name, unit_generator in get_training_inputs(args.image, tuple(args.tile_size)).items():
+        result = benchmark_sorted_views(TiledImage.from_unit_generator(unit_generator()), 10, args.repeat)
+        print(f"{name:>14}: eager {result['eager']:.3f}s {result['eager_memory'] / 2**20:.1f}MB (peak {result['eager_peak'] / 2**20:.1f}MB), "
+              f"lazy {result['lazy']:.3f}s {result['lazy_memory'] / 2**20:.1f}MB (peak {result['lazy_peak'] / 2**20:.1f}MB) "
+              f"({result['eager'] / result['lazy']:.1f}x), "
+              f"sorted {result['sorted']:.4f}s, top {result['top']:.4f}s ({result['sorted'] / result['top']:.1f}x), same: {result['same']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Context-sensitive WFC benchmarks')
+    parser.add_argument('--image', default='zeldaMap.png')
+    parser.add_argument('--tile-size', type=int, nargs=2, default=(16, 16))
+    parser.add_argument('--repeat', type=int, default=3)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('training', help='unit extraction and training (default)')
+    generation = subparsers.add_parser('generation', help='generating outputs over a grid of WFC options, sizes and seeds')
+    generation.add_argument('--units', nargs='+', choices=['stick tiles', 'tiles', '3x3 patterns', 'L patterns'])
+    generation.add_argument('--weighting', nargs='+', choices=list(get_option_names(WeightingOptions).values()))
+    generation.add_argument('--entropy', nargs='+', choices=list(get_option_names(EntropyOptions).values()))
+    generation.add_argument('--updating', nargs='+', choices=list(get_option_names(UpdatingOptions).values()))
+    generation.add_argument('--backtrack', type=int, nargs='+', choices=[0, 1], default=[0, 1])
+    generation.add_argument('--sizes', type=int, nargs='+', default=[10, 20])
+    generation.add_argument('--seeds', type=int, default=3)
+    generation.add_argument('--time-budget', type=float, default=30, help='seconds for each backtracking run')
+    generation.add_argument('--json')
+    generation.add_argument('--csv')
+    args = parser.parse_args()
+    if args.command == 'generation':
+        main_generation(args)
+    else:
+        main_training(args)
+
+if __name__ == "__main__":
+    main()
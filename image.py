@@ -4,8 +4,9 @@ from typing import Tuple
 from utility import get_array_hash, get_arrays_hash
 
 class ImageUnit:
-    def __init__(self):
-        self.number = self._get_number()
+    def __init__(self, number: int=None):
+        # number can be given when it is already known (e.g. loaded from a cache), to keep the same numbers
+        self.number = self._get_number() if number is None else number
 
     def _get_number(self) -> int:
         raise Exception('Not implemented')
@@ -29,9 +30,9 @@ class ImageUnit:
         plt.savefig(filename+'.png',dpi=300,pad_inches=0,bbox_inches='tight')
 
 class Tile(ImageUnit):
-    def __init__(self, data: np.ndarray):
+    def __init__(self, data: np.ndarray, number: int=None):
         self.data = data
-        super().__init__()
+        super().__init__(number)
 
     def _get_number(self) -> int:
         # TODO assumes tile shape doesn't matter
@@ -49,7 +50,7 @@ class Tile(ImageUnit):
 
 class Pattern(ImageUnit):
     CHECK_INPUTS = True
-    def __init__(self, data_array: np.ndarray, pattern_indices: np.ndarray):
+    def __init__(self, data_array: np.ndarray, pattern_indices: np.ndarray, number: int=None):
         self.data_array = data_array
         self.pattern_indices = pattern_indices
         if Pattern.CHECK_INPUTS:
@@ -63,7 +64,7 @@ class Pattern(ImageUnit):
                 if f[0] > s[0] or (f[0] == s[0] and f[1] >= s[1]):
                     raise Exception('Pattern indices not sorted or has duplicates')
         self.repr_index = np.where(np.all(pattern_indices==np.array([0, 0]),axis=1))[0][0]
-        super().__init__()
+        super().__init__(number)
 
     def _get_number(self) -> int:
         return get_arrays_hash(self.data_array, self.pattern_indices)
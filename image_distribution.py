@@ -1,71 +1,378 @@
-from utility import Move, in_bound, add_to_dict
+import os
+import numpy as np
+from utility import Move, in_bound, add_to_dict, pack_rows, unpack_keys
 
 class ImageDistribution:
     MOVESET = Move.CCW
+    VECTORIZED_TRAINING = True # same tables as the loop based _train_*_frequency functions, built with numpy
     def __init__(self):
-        self.unit_frequency = {}
-        self.pair_frequency = [{} for _ in ImageDistribution.MOVESET]
-        self.pair_dir_frequency = {}
-        self.context_frequency = {}
-        self.unit_frequency_sorted = []
-        self.pair_frequency_sorted = [[] for _ in ImageDistribution.MOVESET]
-        self.pair_dir_frequency_sorted = []
-        self.context_frequency_sorted = []
-        self.exists = set()
-        self.unit_numbers = set()
-    
+        # the counts are kept by unit index (contiguous, in order of first appearance), units maps them back to the unit numbers
+        self.units = [] # unit index -> unit number, contiguous indices used by the WFC wave
+        self.unit_index = {} # unit number -> unit index
+        self.unit_counts = np.zeros(0, dtype=np.int64) # unit index -> frequency
+        # pair counts in CSR format, with one row r = a * len(MOVESET) + k for each unit index a and move k: the unit indices seen at MOVESET[k]
+        # from a are pair_indices[pair_indptr[r]:pair_indptr[r+1]] (sorted), with their frequencies at the same positions of pair_counts
+        self.pair_indptr = np.zeros(1, dtype=np.int64)
+        self.pair_indices = np.zeros(0, dtype=np.int64)
+        self.pair_counts = np.zeros(0, dtype=np.int64)
+        # context counts as sorted keys, each packing (neighbor unit indices at MOVESET, center unit index) in base context_base,
+        # shifted by one so None (neighbor not counted) is 0; the contexts with the same neighbors are next to each other
+        self.context_base = 1
+        self.context_keys = np.zeros(0, dtype=np.int64)
+        self.context_counts = np.zeros(0, dtype=np.int64)
+        self._derived = {} # tables computed from the counts on first access, cleared when the counts change
+
     def train(self, tiled_image):
-        self._train_unit_frequency(tiled_image)
-        self._train_pair_frequency(tiled_image)
-        self._train_context_frequency(tiled_image)
+        self.update(tiled_image)
+
+    def train_many(self, tiled_images):
+        # tiled_images can be any iterable (e.g. a generator), only one tiled image is used at a time
+        for tiled_image in tiled_images:
+            self.update(tiled_image)
+
+    def update(self, tiled_image):
+        if ImageDistribution.VECTORIZED_TRAINING:
+            self._train_vectorized(tiled_image)
+        else:
+            self._train_unit_frequency(tiled_image)
+            self._train_pair_frequency(tiled_image)
+            self._train_context_frequency(tiled_image)
+        self._derived = {}
+
+    def _add_units(self, numbers) -> np.ndarray:
+        # unit indices of the unit numbers, adding the new ones at the end
+        indices = []
+        for number in numbers:
+            if number not in self.unit_index:
+                self.unit_index[number] = len(self.units)
+                self.units.append(number)
+            indices.append(self.unit_index[number])
+        added = len(self.units) - len(self.unit_counts)
+        if added > 0:
+            self.unit_counts = np.concatenate((self.unit_counts, np.zeros(added, dtype=np.int64)))
+            self.pair_indptr = np.concatenate((self.pair_indptr, np.full(added * len(ImageDistribution.MOVESET), self.pair_indptr[-1])))
+        return np.array(indices, dtype=np.int64)
+
+    def _add_pair_counts(self, a, b, k, counts):
+        # adds the counts of the pairs (a, b at MOVESET[k] from a) of unit indices, the same pair can be repeated
+        if len(counts) == 0:
+            return
+        n, n_moves = len(self.units), len(ImageDistribution.MOVESET)
+        rows = np.repeat(np.arange(n * n_moves), np.diff(self.pair_indptr))
+        keys = np.concatenate((rows * n + self.pair_indices, (np.asarray(a) * n_moves + k) * n + b))
+        keys, inverse = np.unique(keys, return_inverse=True)
+        pair_counts = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(pair_counts, inverse.reshape(-1), np.concatenate((self.pair_counts, counts)))
+        self.pair_indices = keys % n
+        self.pair_counts = pair_counts
+        self.pair_indptr = np.concatenate(([0], np.cumsum(np.bincount(keys // n, minlength=n * n_moves))))
+
+    def _add_context_counts(self, rows, counts):
+        # adds the counts of the contexts, rows of (center, neighbors at MOVESET) unit indices shifted by one (0 for None)
+        if len(counts) == 0:
+            return
+        base = len(self.units) + 1
+        keys = self.context_keys
+        if base != self.context_base: # new units, repack the keys
+            keys = pack_rows(unpack_keys(keys, self.context_base, 5), base)
+        keys, inverse = np.unique(np.concatenate((keys, pack_rows(np.asarray(rows)[:, [1, 2, 3, 4, 0]], base))), return_inverse=True)
+        context_counts = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(context_counts, inverse.reshape(-1), np.concatenate((self.context_counts, counts)))
+        self.context_base, self.context_keys, self.context_counts = base, keys, context_counts
+
+    def _get_pair_rows(self):
+        # (a, b, k, frequency) arrays of all the pairs
+        a, k = np.divmod(np.repeat(np.arange(len(self.pair_indptr) - 1), np.diff(self.pair_indptr)), len(ImageDistribution.MOVESET))
+        return a, self.pair_indices, k, self.pair_counts
+
+    def _get_context_rows(self):
+        # (center, neighbors at MOVESET) unit indices shifted by one (0 for None), one row per context
+        return unpack_keys(self.context_keys, self.context_base, 5)[:, [4, 0, 1, 2, 3]]
+
+    def merge(self, other: 'ImageDistribution'):
+        indices = self._add_units(other.units) # unit index in other -> unit index in self
+        self.unit_counts = self.unit_counts + np.bincount(indices, weights=other.unit_counts, minlength=len(self.units)).astype(np.int64)
+        a, b, k, counts = other._get_pair_rows()
+        self._add_pair_counts(indices[a], indices[b], k, counts)
+        self._add_context_counts(np.concatenate(([0], indices + 1))[other._get_context_rows()], other.context_counts)
+        self._derived = {}
+
+    def to_arrays(self) -> dict:
+        # all the counts, for saving with np.savez
+        arrays = {
+            'units': np.array(self.units, dtype=np.int64),
+            'unit_counts': self.unit_counts,
+            'pair_indptr': self.pair_indptr,
+            'pair_indices': self.pair_indices,
+            'pair_counts': self.pair_counts,
+            'context_counts': self.context_counts,
+        }
+        if self.context_keys.dtype == object: # too many units to pack the keys in int64
+            arrays['context_rows'] = self._get_context_rows()
+        else:
+            arrays['context_keys'] = self.context_keys
+            arrays['context_base'] = np.array(self.context_base)
+        return arrays
+
+    def from_arrays(arrays: dict) -> 'ImageDistribution':
+        # the arrays are used as they are, so they can be memory-mapped (see load_npy)
+        dist = ImageDistribution()
+        dist._add_units(arrays['units'].tolist())
+        if 'unit_counts' not in arrays: # saved before the counts were kept in arrays: rows of unit indices (-1 for None) and frequencies
+            dist.unit_counts[arrays['unit_frequency'][:, 0]] = arrays['unit_frequency'][:, 1]
+            pair_rows = arrays['pair_dir_frequency']
+            dist._add_pair_counts(pair_rows[:, 0], pair_rows[:, 1], pair_rows[:, 2], pair_rows[:, 3])
+            context_rows = arrays['context_frequency']
+            dist._add_context_counts(context_rows[:, :-1] + 1, context_rows[:, -1])
+            return dist
+        dist.unit_counts = arrays['unit_counts']
+        dist.pair_indptr, dist.pair_indices, dist.pair_counts = arrays['pair_indptr'], arrays['pair_indices'], arrays['pair_counts']
+        if 'context_rows' in arrays:
+            dist._add_context_counts(arrays['context_rows'], arrays['context_counts'])
+        else:
+            dist.context_base, dist.context_keys, dist.context_counts = int(arrays['context_base']), arrays['context_keys'], arrays['context_counts']
+        return dist
+
+    def save(self, filename) -> None:
+        np.savez(filename, **self.to_arrays())
+
+    def load(filename) -> 'ImageDistribution':
+        with np.load(filename) as arrays:
+            return ImageDistribution.from_arrays(dict(arrays))
+
+    def save_npy(self, directory) -> None:
+        # one .npy file per array, which load_npy can memory-map instead of reading
+        os.makedirs(directory, exist_ok=True)
+        for name, array in self.to_arrays().items():
+            np.save(os.path.join(directory, name + '.npy'), array)
+
+    def load_npy(directory, mmap_mode='r') -> 'ImageDistribution':
+        return ImageDistribution.from_arrays({name[:-4]: np.load(os.path.join(directory, name), mmap_mode=mmap_mode)
+                                              for name in os.listdir(directory) if name.endswith('.npy')})
+
+    def _get_derived(self, name, compute):
+        if name not in self._derived:
+            self._derived[name] = compute()
+        return self._derived[name]
+
+    # tables keyed by unit numbers, derived from the counts
+
+    @property
+    def unit_frequency(self): # unit number -> frequency
+        return self._get_derived('unit_frequency', lambda: dict(zip(self.units, self.unit_counts.tolist())))
+
+    @property
+    def pair_frequency(self): # [k]: (unit number, unit number at MOVESET[k] from it) -> frequency
+        def compute():
+            pair_frequency = [{} for _ in ImageDistribution.MOVESET]
+            for (a, b, k), frequency in self.pair_dir_frequency.items():
+                pair_frequency[k][(a, b)] = frequency
+            return pair_frequency
+        return self._get_derived('pair_frequency', compute)
+
+    @property
+    def pair_dir_frequency(self): # (unit number, unit number at MOVESET[k] from it, k) -> frequency
+        def compute():
+            units = np.array(self.units, dtype=np.int64)
+            a, b, k, counts = self._get_pair_rows()
+            return dict(zip(zip(units[a].tolist(), units[b].tolist(), k.tolist()), counts.tolist()))
+        return self._get_derived('pair_dir_frequency', compute)
+
+    @property
+    def exists(self):
+        return self._get_derived('exists', lambda: set(self.pair_dir_frequency))
+
+    @property
+    def context_frequency(self): # (unit number, neighbor unit numbers or None) -> frequency
+        def compute():
+            units = [None] + self.units
+            return {tuple(units[u] for u in row): frequency for row, frequency in zip(self._get_context_rows().tolist(), self.context_counts.tolist())}
+        return self._get_derived('context_frequency', compute)
+
+    @property
+    def unit_numbers(self):
+        return set(self.units)
+
+    @property
+    def unit_frequency_sorted(self):
+        return self._get_derived('unit_frequency_sorted', lambda: sorted(list(self.unit_frequency.items()), key=lambda keyvalue: -keyvalue[1]))
+
+    @property
+    def pair_frequency_sorted(self):
+        return self._get_derived('pair_frequency_sorted', lambda: [sorted(list(self.pair_frequency[k].items()), key=lambda keyvalue: -keyvalue[1])
+                                                                   for k in range(len(ImageDistribution.MOVESET))])
+
+    @property
+    def pair_dir_frequency_sorted(self):
+        return self._get_derived('pair_dir_frequency_sorted', lambda: sorted(list(self.pair_dir_frequency.items()), key=lambda keyvalue: -keyvalue[1]))
+
+    @property
+    def context_frequency_sorted(self):
+        return self._get_derived('context_frequency_sorted', lambda: sorted(list(self.context_frequency.items()), key=lambda keyvalue: -keyvalue[1]))
+
+    # the first k items of the *_sorted lists, without sorting the whole table
+
+    def get_top_unit_frequency(self, k):
+        top = self._get_top_indices(self.unit_counts, k)
+        return list(zip([self.units[i] for i in top.tolist()], self.unit_counts[top].tolist()))
+
+    def get_top_pair_frequency(self, k, move_number):
+        a, b, moves, counts = self._get_pair_rows()
+        positions = np.flatnonzero(moves == move_number)
+        top = positions[self._get_top_indices(counts[positions], k)]
+        return [((self.units[x], self.units[y]), frequency) for x, y, frequency in zip(a[top].tolist(), b[top].tolist(), counts[top].tolist())]
+
+    def get_top_pair_dir_frequency(self, k):
+        a, b, moves, counts = self._get_pair_rows()
+        top = self._get_top_indices(counts, k)
+        return [((self.units[x], self.units[y], move), frequency)
+                for x, y, move, frequency in zip(a[top].tolist(), b[top].tolist(), moves[top].tolist(), counts[top].tolist())]
+
+    def get_top_context_frequency(self, k):
+        top = self._get_top_indices(self.context_counts, k)
+        units = [None] + self.units
+        rows = unpack_keys(self.context_keys[top], self.context_base, 5)[:, [4, 0, 1, 2, 3]]
+        return [(tuple(units[u] for u in row), frequency) for row, frequency in zip(rows.tolist(), self.context_counts[top].tolist())]
+
+    def _get_top_indices(self, counts, k):
+        # indices of the k largest counts, largest first and lower index first on ties (like the stable sorts of the *_sorted lists)
+        if k >= len(counts):
+            return np.argsort(-counts, kind='stable')
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        threshold = np.partition(counts, len(counts) - k)[len(counts) - k] # the k-th largest count
+        above = np.flatnonzero(counts > threshold)
+        top = np.concatenate((above, np.flatnonzero(counts == threshold)[:k - len(above)]))
+        return top[np.argsort(-counts[top], kind='stable')]
+
+    @property
+    def propagator(self): # [k, a, b]: unit index b can be at move k from unit index a
+        return self._get_derived('propagator', self._get_propagator)
+
+    @property
+    def unit_frequencies(self): # unit index -> frequency
+        return self._get_derived('unit_frequencies', lambda: self.unit_counts.astype(float))
 
     def get_unit_frequency(self, unit):
-        return self.unit_frequency.get(unit, 0)
+        index = self.unit_index.get(unit)
+        return 0 if index is None else int(self.unit_counts[index])
 
     def get_context_frequency(self, context):
-        return self.context_frequency.get(context, 0)
+        if any(u is not None and u not in self.unit_index for u in context):
+            return 0
+        key = 0
+        for u in context[1:] + context[:1]:
+            key = key * self.context_base + (0 if u is None else self.unit_index[u] + 1)
+        position = np.searchsorted(self.context_keys, key)
+        return int(self.context_counts[position]) if position < len(self.context_keys) and self.context_keys[position] == key else 0
+
+    def get_unit_index(self, unit):
+        return self.unit_index[unit]
+
+    def get_unit_frequencies(self):
+        return self.unit_frequencies
+
+    def get_context_weights(self, neighbors):
+        # frequency of each unit index in the context given by the neighbor unit indices, as one vector
+        weights = np.zeros(len(self.units))
+        base = self.context_base
+        prefix = 0
+        for u in neighbors:
+            prefix = prefix * base + (0 if u is None else int(u) + 1)
+        # the centers with these neighbors are packed in the keys from prefix * base + 1 to prefix * base + base - 1
+        start = np.searchsorted(self.context_keys, prefix * base + 1, side='left')
+        end = np.searchsorted(self.context_keys, prefix * base + base - 1, side='right')
+        weights[(self.context_keys[start:end] % base - 1).astype(np.int64)] = self.context_counts[start:end]
+        return weights
+
+    def get_compatible(self, unit_index, move_number):
+        # boolean mask over unit indices that can be placed at MOVESET[move_number] from unit_index
+        return self.propagator[move_number, unit_index]
 
     def _train_unit_frequency(self, tiled_image):
         units = tiled_image.unit_numbers
+        indices = []
         for i in range(units.shape[0]):
             for j in range(units.shape[1]):
-                add_to_dict(self.unit_frequency, units[i, j])
-                self.unit_numbers.add(units[i, j])
-        self.unit_frequency_sorted = sorted(list(self.unit_frequency.items()), key=lambda keyvalue: -keyvalue[1])
-    
+                indices.append(self._add_units([units[i, j]])[0])
+        self.unit_counts = self.unit_counts + np.bincount(indices, minlength=len(self.units))
+
     def _train_pair_frequency(self, tiled_image):
         units = tiled_image.unit_numbers
+        pair_frequency = {}
         for i in range(units.shape[0]):
             for j in range(units.shape[1]):
                 for k in range(len(ImageDistribution.MOVESET)):
                     dx, dy = ImageDistribution.MOVESET[k]
                     if in_bound(i+dx, j+dy, units):
-                        add_to_dict(self.pair_frequency[k], (units[i, j], units[i+dx, j+dy]))
-                        add_to_dict(self.pair_dir_frequency, (units[i, j], units[i+dx, j+dy], k))
-                        self.exists.add((units[i, j], units[i+dx, j+dy], k))
-              
-        for k in range(len(ImageDistribution.MOVESET)):
-            self.pair_frequency_sorted[k] = sorted(list(self.pair_frequency[k].items()), key=lambda keyvalue: -keyvalue[1])
-        self.pair_dir_frequency_sorted = sorted(list(self.pair_dir_frequency.items()), key=lambda keyvalue: -keyvalue[1])
+                        add_to_dict(pair_frequency, (self.unit_index[units[i, j]], self.unit_index[units[i+dx, j+dy]], k))
+        pairs = np.array(list(pair_frequency), dtype=np.int64).reshape(-1, 3)
+        self._add_pair_counts(pairs[:, 0], pairs[:, 1], pairs[:, 2], np.array(list(pair_frequency.values()), dtype=np.int64))
 
     def _train_context_frequency(self, tiled_image):
         units = tiled_image.unit_numbers
+        context_frequency = {}
         for i in range(units.shape[0]):
             for j in range(units.shape[1]):
-                context = [units[i, j], None, None, None, None]
+                context = [self.unit_index[units[i, j]], None, None, None, None]
                 for k in range(len(ImageDistribution.MOVESET)):
                     dx, dy = ImageDistribution.MOVESET[k]
                     if in_bound(i+dx, j+dy, units):
-                        context[k+1] = units[i+dx, j+dy]
+                        context[k+1] = self.unit_index[units[i+dx, j+dy]]
                 # TODO None senario probably won't happen at all
                 for e1 in range(1 if context[1] is None else 2):
                     for e2 in range(1 if context[2] is None else 2):
                         for e3 in range(1 if context[3] is None else 2):
                             for e4 in range(1 if context[4] is None else 2):
-                                context_key = (units[i, j],
+                                context_key = (context[0],
                                               None if e1 == 1 else context[1],
                                               None if e2 == 1 else context[2],
                                               None if e3 == 1 else context[3],
                                               None if e4 == 1 else context[4])
-                                add_to_dict(self.context_frequency, context_key)
-        self.context_frequency_sorted = sorted(list(self.context_frequency.items()), key=lambda keyvalue: -keyvalue[1])
\ No newline at end of file
+                                add_to_dict(context_frequency, context_key)
+        rows = np.array([[0 if u is None else u + 1 for u in context] for context in context_frequency], dtype=np.int64).reshape(-1, 5)
+        self._add_context_counts(rows, np.array(list(context_frequency.values()), dtype=np.int64))
+
+    def _get_propagator(self):
+        propagator = np.zeros((len(ImageDistribution.MOVESET), len(self.units), len(self.units)), dtype=bool)
+        a, b, k, _ = self._get_pair_rows()
+        propagator[k, a, b] = True
+        return propagator
+
+    def _train_vectorized(self, tiled_image):
+        ids = tiled_image.unit_ids
+
+        # unit indices of the tiled image's ids, new units are added in order of first appearance
+        seen, first = np.unique(ids.reshape(-1), return_index=True)
+        seen = seen[np.argsort(first)]
+        indices = np.full(len(tiled_image.id_to_number), -1, dtype=np.int64)
+        indices[seen] = self._add_units(tiled_image.id_to_number[seen].tolist())
+        ids = indices[ids]
+        self.unit_counts = self.unit_counts + np.bincount(ids.reshape(-1), minlength=len(self.units))
+
+        neighbors = np.full((len(ImageDistribution.MOVESET),) + ids.shape, -1, dtype=np.int64) # -1 for out of bound
+        pair_rows = []
+        for k in range(len(ImageDistribution.MOVESET)):
+            dx, dy = ImageDistribution.MOVESET[k]
+            # source positions (i, j) with (i+dx, j+dy) in bound
+            xs = slice(max(0, -dx), ids.shape[0] - max(0, dx))
+            ys = slice(max(0, -dy), ids.shape[1] - max(0, dy))
+            neighbors[k][xs, ys] = ids[xs.start+dx:xs.stop+dx, ys.start+dy:ys.stop+dy]
+            pair_rows.append(np.stack((ids[xs, ys].reshape(-1), neighbors[k][xs, ys].reshape(-1), np.full(ids[xs, ys].size, k)), axis=1))
+        pair_rows = np.concatenate(pair_rows)
+        self._add_pair_counts(pair_rows[:, 0], pair_rows[:, 1], pair_rows[:, 2], np.ones(len(pair_rows), dtype=np.int64))
+
+        # every subset of the in bound neighbors; indices are shifted by one so None is 0
+        n_moves = len(ImageDistribution.MOVESET)
+        context_rows = []
+        for subset in range(2**n_moves):
+            dropped = [(subset >> k) & 1 == 1 for k in range(n_moves)]
+            valid = np.ones(ids.shape, dtype=bool)
+            row = [ids + 1]
+            for k in range(n_moves):
+                if dropped[k]:
+                    valid &= neighbors[k] >= 0
+                row.append(np.zeros(ids.shape, dtype=np.int64) if dropped[k] else neighbors[k] + 1)
+            context_rows.append(np.stack([r[valid] for r in row], axis=1))
+        context_rows = np.concatenate(context_rows)
+        self._add_context_counts(context_rows, np.ones(len(context_rows), dtype=np.int64))
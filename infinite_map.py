@@ -0,0 +1,103 @@
+import sys
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import Tuple
+from WFC import WFC, ExistingTile
+from utility import get_seed
+
+class InfiniteMap:
+    # generates an unbounded map chunk by chunk, on demand
+    # a chunk only depends on the world seed, its coordinates and the chunks generated before it in the checkerboard order
+    # ((even, even), (even, odd), (odd, even), (odd, odd)), whose borders are pinned as existing tiles, so any chunk can be
+    # generated again instead of stored, regardless of the order the chunks are requested in
+    PHASES = [(0, 0), (0, 1), (1, 0), (1, 1)]
+
+    def __init__(self, wfc: WFC, chunk_size: Tuple[int, int], seed: int=0, overlap: int=2, backtrack: bool=False,
+                 max_attempts: int=3, max_memory: int=2**28, **backtrack_options):
+        self.wfc = wfc
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.overlap = overlap
+        self.backtrack = backtrack
+        self.max_attempts = max_attempts
+        self.max_memory = max_memory # bytes, least recently used chunks are dropped above this size
+        if backtrack:
+            backtrack_options.setdefault('max_backtracks', 1000) # keeps the latency of each attempt bounded
+        self.backtrack_options = backtrack_options
+        self.chunks = OrderedDict() # (cx, cy) -> generated chunk, least recently used first
+        self.memory = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'failed': 0, 'last_latency': 0, 'max_latency': 0}
+
+    def _get_phase(self, cx, cy):
+        return InfiniteMap.PHASES.index((cx % 2, cy % 2))
+
+    def _get_chunk_memory(self, chunk):
+        return chunk.nbytes + sum(sys.getsizeof(unit) for unit in chunk.flat)
+
+    def _generate_chunk(self, cx, cy):
+        w, h = self.chunk_size
+        x0, y0 = cx * w - self.overlap, cy * h - self.overlap
+        region_size = (w + 2 * self.overlap, h + 2 * self.overlap)
+        pins = []
+        phase = self._get_phase(cx, cy)
+        for dx in [-1, 0, 1]:
+            for dy in [-1, 0, 1]:
+                if (dx, dy) == (0, 0) or self._get_phase(cx + dx, cy + dy) >= phase:
+                    continue
+                # the positions of the neighbor chunk inside the region of this chunk
+                neighbor = self.get_chunk(cx + dx, cy + dy)
+                i0, j0 = max((cx + dx) * w, x0), max((cy + dy) * h, y0)
+                i1, j1 = min((cx + dx + 1) * w, x0 + region_size[0]), min((cy + dy + 1) * h, y0 + region_size[1])
+                for i in range(i0, i1):
+                    for j in range(j0, j1):
+                        unit = neighbor[i - (cx + dx) * w, j - (cy + dy) * h]
+                        if unit is not None:
+                            pins.append(ExistingTile((i - x0, j - y0), unit))
+        for attempt in range(self.max_attempts):
+            generated = self.wfc._solve_chunk(region_size, pins, get_seed(self.seed, cx, cy, attempt), self.backtrack, self.backtrack_options)
+            if generated is not None and all(unit is not None for unit in generated.flat):
+                break
+        else:
+            # keep the chunk, with the positions that couldn't be solved left empty like generating without backtracking
+            self.stats['failed'] += 1
+            while generated is None:
+                try:
+                    generated = self.wfc.generate(region_size, get_seed(self.seed, cx, cy), pins)
+                except Exception:
+                    # leave out the borders which conflict with each other
+                    conflicting = set(self.wfc.conflicting_tiles)
+                    pins = [pin for pin in pins if tuple(pin.pos) not in conflicting]
+        return generated[self.overlap:self.overlap + w, self.overlap:self.overlap + h].copy()
+
+    def get_chunk(self, cx: int, cy: int) -> np.ndarray:
+        # the unit numbers of the positions [cx * chunk_size[0], (cx + 1) * chunk_size[0]) x [cy * chunk_size[1], (cy + 1) * chunk_size[1])
+        if (cx, cy) in self.chunks:
+            self.stats['hits'] += 1
+            self.chunks.move_to_end((cx, cy))
+            return self.chunks[(cx, cy)]
+        self.stats['misses'] += 1
+        start = time.perf_counter()
+        chunk = self._generate_chunk(cx, cy)
+        latency = time.perf_counter() - start
+        self.stats['last_latency'] = latency
+        self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+        self.chunks[(cx, cy)] = chunk
+        self.memory += self._get_chunk_memory(chunk)
+        while self.memory > self.max_memory and len(self.chunks) > 1:
+            _, evicted = self.chunks.popitem(last=False)
+            self.memory -= self._get_chunk_memory(evicted)
+            self.stats['evictions'] += 1
+        return chunk
+
+    def get_area(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        # the unit numbers of the positions [x0, x1) x [y0, y1), generating the chunks covering them
+        w, h = self.chunk_size
+        area = np.empty((x1 - x0, y1 - y0), dtype=object)
+        for cx in range(x0 // w, -(-x1 // w)):
+            for cy in range(y0 // h, -(-y1 // h)):
+                chunk = self.get_chunk(cx, cy)
+                i0, j0 = max(cx * w, x0), max(cy * h, y0)
+                i1, j1 = min((cx + 1) * w, x1), min((cy + 1) * h, y1)
+                area[i0 - x0:i1 - x0, j0 - y0:j1 - y0] = chunk[i0 - cx * w:i1 - cx * w, j0 - cy * h:j1 - cy * h]
+        return area
@@ -2,9 +2,12 @@ import numpy as np
 import imageio.v2 as imageio
 import matplotlib.pyplot as plt
 from tiled_image import TiledImage, TileGenerator, nxmPatternGenerator, UpLeftLPatternGenerator
-from WFC import EntropyOptions, WeightingOptions, UpdatingOptions, WFC
+from WFC import EntropyOptions, WeightingOptions, UpdatingOptions, WFC, generate_configurations
 from image_distribution import ImageDistribution
 from utility import GifMaker
+from training_cache import TrainingCache
+
+TRAINING_CACHE = TrainingCache() # set to None to always break the input into tiles and train again
 
 def get_stick_data():
     arr = np.ones((7, 7, 3)) * 0.4
@@ -20,6 +23,14 @@ def get_image_data(filename):
     arr = np.asarray(im)/255
     return arr
 
+def get_trained(unit_generator, cache=TRAINING_CACHE):
+    if cache is not None:
+        return cache.get(unit_generator)
+    ti = TiledImage.from_unit_generator(unit_generator)
+    id = ImageDistribution()
+    id.train(ti)
+    return ti, id
+
 def visualize_tile_vs_pattern(image_data, tile_size, pattern_generator_func):
     n, m, _ = image_data.shape
     if n % tile_size[0] != 0 or m % tile_size[1] != 0:
@@ -45,16 +56,13 @@ def visualize_tile_vs_pattern(image_data, tile_size, pattern_generator_func):
 
 
 def visualize_wfc_decision_heuristics(unit_generator, size, seed=42, backtrack=False, axs=None,
-                                 entropy_option=EntropyOptions.TOP_LEFT, updating_option=UpdatingOptions.CHAIN):
-    print("breaking input into tiles...")
-    ti = TiledImage.from_unit_generator(unit_generator)
+                                 entropy_option=EntropyOptions.TOP_LEFT, updating_option=UpdatingOptions.CHAIN, cache=TRAINING_CACHE):
+    print("breaking input into tiles and training the distribution...")
+    ti, id = get_trained(unit_generator, cache)
     if axs is None:
         _, axs = plt.subplots(nrows=1, ncols=4, figsize=(16, 4))
     axs[0].set_title('Source', fontsize=22)
     ti.display(axs[0])
-    print("training the distribution...")
-    id = ImageDistribution()
-    id.train(ti)
     print("running wfc with uniform decision heuristic...")
     axs[1].set_title('Uniform', fontsize=22)
     wfc = WFC(id, WeightingOptions.UNIFORM, updating_option, entropy_option)
@@ -70,16 +78,13 @@ def visualize_wfc_decision_heuristics(unit_generator, size, seed=42, backtrack=F
     plt.show()
 
 def visualize_wfc_selection_heuristics(unit_generator, size, seed=42, backtrack=False, axs=None,
-                                 weighting_option=WeightingOptions.UNIFORM, updating_option=UpdatingOptions.CHAIN):
-    print("breaking input into tiles...")
-    ti = TiledImage.from_unit_generator(unit_generator)
+                                 weighting_option=WeightingOptions.UNIFORM, updating_option=UpdatingOptions.CHAIN, cache=TRAINING_CACHE):
+    print("breaking input into tiles and training the distribution...")
+    ti, id = get_trained(unit_generator, cache)
     if axs is None:
         _, axs = plt.subplots(nrows=1, ncols=5, figsize=(20, 4))
     axs[0].set_title('Source', fontsize=22)
     ti.display(axs[0])
-    print("training the distribution...")
-    id = ImageDistribution()
-    id.train(ti)
     print("running wfc with top-left to bottom-right selection heuristic...")
     axs[1].set_title('Top-Left', fontsize=15)
     wfc = WFC(id, weighting_option, updating_option, EntropyOptions.TOP_LEFT)
@@ -99,9 +104,9 @@ def visualize_wfc_selection_heuristics(unit_generator, size, seed=42, backtrack=
     plt.show()
 
 def visualize_single_wfc(unit_generator, size, seed=42, backtrack=False, weighting_option=WeightingOptions.UNIFORM,
-                        entropy_option=EntropyOptions.TOP_LEFT, updating_option=UpdatingOptions.CHAIN):
-    print("breaking input into tiles...")
-    ti = TiledImage.from_unit_generator(unit_generator)
+                        entropy_option=EntropyOptions.TOP_LEFT, updating_option=UpdatingOptions.CHAIN, cache=TRAINING_CACHE):
+    print("breaking input into tiles and training the distribution...")
+    ti, id = get_trained(unit_generator, cache)
     decision_str = 'Uniform' if weighting_option==WeightingOptions.UNIFORM else\
         'Tile Frequency' if weighting_option==WeightingOptions.TILE_FREQUENCY else\
         'Context-sensitive' if weighting_option==WeightingOptions.CONTEXT_SENSITIVE else 'UNKNOWN'
@@ -110,9 +115,6 @@ def visualize_single_wfc(unit_generator, size, seed=42, backtrack=False, weighti
         'Number-of-options' if entropy_option==EntropyOptions.NUMBER_OF_OPTIONS else\
         'Shannon' if entropy_option==EntropyOptions.SHANNON else 'UNKNOWN'
     plt.title(f'WFC - {decision_str} Decision and {selection_str} Selection Heuristic', fontsize=15)
-    print("training the distribution...")
-    id = ImageDistribution()
-    id.train(ti)
     print("running wfc...")
     wfc = WFC(id, weighting_option, updating_option, entropy_option)
     ti.from_generated(wfc.generate(size, seed=seed, backtrack=backtrack)).display()
@@ -120,18 +122,48 @@ def visualize_single_wfc(unit_generator, size, seed=42, backtrack=False, weighti
 
 def save_wfc_gif(unit_generator, size, gif_name, seed=42, backtrack=False, weighting_option=WeightingOptions.UNIFORM,
                 entropy_option=EntropyOptions.TOP_LEFT, updating_option=UpdatingOptions.CHAIN,  
-                fps=24, repeat=False, is_gif_weighted=True):
-    print("breaking input into tiles...")
-    ti = TiledImage.from_unit_generator(unit_generator)
-    print("training the distribution...")
-    id = ImageDistribution()
-    id.train(ti)
+                fps=24, repeat=False, is_gif_weighted=True, cache=TRAINING_CACHE):
+    print("breaking input into tiles and training the distribution...")
+    ti, id = get_trained(unit_generator, cache)
     print("running wfc in creating the gif frames...")
     wfc = WFC(id, weighting_option, updating_option, entropy_option)
-    gm = GifMaker(wfc, ti, is_gif_weighted)
+    gm = GifMaker(wfc, ti, is_gif_weighted, gif_name=gif_name, fps=fps, repeat=repeat) # frames are written as they are made
     wfc.generate(size, seed=seed, backtrack=backtrack, gif_maker=gm)
     print("saving the gif...")
-    gm.save_gif(gif_name, fps=fps, repeat=repeat)
+    gm.save_gif()
+
+def get_comparison_data(rows, spacing=4):
+    # puts rows of images (display data arrays) together in one uint8 image, with white space between them
+    def to_uint8(image):
+        return (np.clip(image, 0, 1) * 255).astype(np.uint8) if image.dtype != np.uint8 else image
+    def concatenate(images, axis):
+        # pads the images to the same size on the other axis, and puts them next to each other with white space in between
+        size = max(image.shape[1 - axis] for image in images)
+        parts = []
+        for image in images:
+            padding = [(0, 0)] * image.ndim
+            padding[1 - axis] = (0, size - image.shape[1 - axis])
+            gap_shape = list(image.shape)
+            gap_shape[1 - axis], gap_shape[axis] = size, spacing
+            parts += [np.pad(image, padding, constant_values=255), np.full(gap_shape, 255, dtype=np.uint8)]
+        return np.concatenate(parts[:-1], axis=axis)
+    return concatenate([concatenate([to_uint8(image) for image in row], axis=1) for row in rows], axis=0)
+
+def save_wfc_comparison(unit_generator, size, configurations, seeds, filename, show_source=True, max_workers=None, cache=TRAINING_CACHE,
+                        **backtrack_options):
+    # runs every configuration, a (weighting_option, entropy_option, updating_option, backtrack) tuple, with every seed in parallel
+    # and saves a png with the source in the first row, then one row per seed and one column per configuration, without using matplotlib
+    print("breaking input into tiles and training the distribution...")
+    ti, id = get_trained(unit_generator, cache)
+    print("running wfc with {} configurations and {} seeds...".format(len(configurations), len(seeds)))
+    configurations = [tuple(configuration) for configuration in configurations]
+    outputs = {}
+    for configuration, seed, generated in generate_configurations(id, configurations, seeds, size, max_workers=max_workers, **backtrack_options):
+        outputs[(configuration, seed)] = ti.from_generated(generated).get_display_data()
+    rows = [[ti.get_display_data()]] if show_source else []
+    rows += [[outputs[(configuration, seed)] for configuration in configurations] for seed in seeds]
+    print("saving the comparison...")
+    imageio.imwrite('{}.png'.format(filename), get_comparison_data(rows))
 
 def main():
     stick_data = get_stick_data()
@@ -189,6 +221,13 @@ def main():
 
     # Other Types of Output:
 
+    ### Comparison Sheets
+    # save_wfc_comparison runs a list of configurations over a list of seeds in parallel and saves them as one png (one row per seed)
+    #>>> save_wfc_comparison(TileGenerator(zelda_data, zelda_tile_size), output_size,
+    #>>>                     [(weighting_option, EntropyOptions.SHANNON, UpdatingOptions.AC4, True) for weighting_option in
+    #>>>                      [WeightingOptions.UNIFORM, WeightingOptions.TILE_FREQUENCY, WeightingOptions.CONTEXT_SENSITIVE]],
+    #>>>                     range(10), 'decision_heuristics')
+
     ### Gif Output
     # you can use the save_wfc_gif function to get gif outputs
     # this will take some time, around a minute for each of the example below
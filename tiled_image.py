@@ -2,6 +2,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from typing import Tuple
 from image import ImageUnit, Tile, Pattern, nxmPattern, UpLeftLPattern
+from utility import write_png
 
 class ImageUnitGenerator:
     def __init__(self, data: np.ndarray, blank: ImageUnit):
@@ -17,6 +18,41 @@ class ImageUnitGenerator:
     def get_blank(self):
         return self.blank
 
+    def get_all(self):
+        # all the units at once: the grid of unit numbers and the number -> unit table (in order of first appearance)
+        number_to_unit = {}
+        size = self.get_size()
+        unit_numbers = np.zeros(size, dtype=np.int64)
+        unit = self.get_next()
+        pos = [0, 0]
+        while unit is not None:
+            if unit.number not in number_to_unit:
+                number_to_unit[unit.number] = unit
+            unit_numbers[(pos[0], pos[1])] = unit.number
+            pos[1] += 1
+            if pos[1] >= size[1]:
+                pos[0] += 1
+                pos[1] = 0
+            unit = self.get_next()
+        return unit_numbers, number_to_unit
+
+    def _get_tile_grid(self, data: np.ndarray, tile_size: Tuple[int, int]):
+        # splits data into its (n, m) grid of tiles, and returns the unique tiles and the tile id of each grid position
+        n, m = int(data.shape[0]/tile_size[0]), int(data.shape[1]/tile_size[1])
+        tiles = data[:n*tile_size[0], :m*tile_size[1]].reshape(n, tile_size[0], m, tile_size[1], data.shape[2]).swapaxes(1, 2)
+        tiles = np.ascontiguousarray(tiles).reshape((n*m,) + (tile_size[0], tile_size[1], data.shape[2]))
+        tile_bytes = tiles.reshape(n*m, -1).view(np.dtype((np.void, tiles[0].nbytes))).reshape(-1) # compare the exact bytes, as the hash does
+        _, first, tile_ids = np.unique(tile_bytes, return_index=True, return_inverse=True)
+        return tiles[first], tile_ids.reshape(n, m)
+
+    def _get_first_appearance_order(self, unit_ids: np.ndarray):
+        # unique ids ordered by their first appearance in the row-major unit_ids grid, and each position's index in that order
+        _, first, inverse = np.unique(unit_ids, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        return first[order], rank[inverse].reshape(unit_ids.shape[:2])
+
     def _pointer_next(self, step: Tuple[int, int], start: Tuple[int, int], end: Tuple[int, int]) -> None:
         if not hasattr(self, "pointer"):
             self.pointer = [start[0], start[1]]
@@ -49,6 +85,13 @@ class TileGenerator(ImageUnitGenerator):
             return None
         return Tile.from_data(self.data, self.pointer[0], self.pointer[1], self.tile_size)
 
+    def get_all(self):
+        tiles, tile_ids = self._get_tile_grid(self.data, self.tile_size)
+        first, positions = self._get_first_appearance_order(tile_ids)
+        units = [Tile(tiles[tile_id]) for tile_id in tile_ids.reshape(-1)[first]]
+        numbers = np.array([unit.number for unit in units], dtype=np.int64)
+        return numbers[positions], {unit.number: unit for unit in units}
+
 class PatternGenerator(ImageUnitGenerator):
     def __init__(self, data: np.ndarray, tile_size: Tuple[int, int], blank: Pattern):
         self.tile_size = tile_size
@@ -67,6 +110,20 @@ class PatternGenerator(ImageUnitGenerator):
         self.end_tile = [int(padded_data.shape[0]/self.tile_size[0]) - max_indices[0], int(padded_data.shape[1]/self.tile_size[1]) - max_indices[1]] # tile scale
         self.data = padded_data
 
+    def get_all(self):
+        # patterns as rows of tile ids, so only the unique patterns are built from the pixel data
+        tiles, tile_ids = self._get_tile_grid(self.data, self.tile_size)
+        pattern_indices = self.blank.pattern_indices
+        xs = np.arange(self.start_tile[0], self.end_tile[0])
+        ys = np.arange(self.start_tile[1], self.end_tile[1])
+        pattern_tile_ids = tile_ids[xs[:, None, None] + pattern_indices[:, 0], ys[None, :, None] + pattern_indices[:, 1]]
+        pattern_rows = pattern_tile_ids.reshape(-1, len(pattern_indices))
+        pattern_keys = np.ascontiguousarray(pattern_rows).view(np.dtype((np.void, pattern_rows[0].nbytes))).reshape(-1)
+        first, positions = self._get_first_appearance_order(pattern_keys.reshape(pattern_tile_ids.shape[:2]))
+        units = [Pattern(tiles[row], pattern_indices) for row in pattern_rows[first]]
+        numbers = np.array([unit.number for unit in units], dtype=np.int64)
+        return numbers[positions], {unit.number: unit for unit in units}
+
 class nxmPatternGenerator(PatternGenerator):
     def __init__(self, data: np.ndarray, tile_size: Tuple[int, int], n: int, m: int, blank: nxmPattern=None):
         self.n = n
@@ -100,29 +157,25 @@ class UpLeftLPatternGenerator(PatternGenerator):
         return UpLeftLPattern.from_data(self.data, self.tile_size, self.pointer[0], self.pointer[1], self.n, self.m)
 
 class TiledImage:
+    BULK_EXTRACTION = True # use ImageUnitGenerator.get_all instead of one get_next call per unit
     def __init__(self, number_to_unit, unit_numbers: np.ndarray, blank: ImageUnit):
         self.number_to_unit = number_to_unit
         self.unit_numbers = unit_numbers
         self.blank = blank
         self.number_to_unit[blank.number] = blank
+        # contiguous unit ids, in the order of number_to_unit: unit_ids[i, j] is the id of unit_numbers[i, j], id_to_number maps them back
+        self.id_to_number = np.array(list(self.number_to_unit), dtype=np.int64)
+        order = np.argsort(self.id_to_number)
+        self.unit_ids = order[np.searchsorted(self.id_to_number[order], np.asarray(unit_numbers, dtype=np.int64))]
+        # display data of all units, built once and shared with the tiled images made by from_generated
+        self._atlas_units = self.number_to_unit
+        self._atlases = {}
 
     def from_unit_generator(u_gen: ImageUnitGenerator) -> 'TiledImage':
-        number_to_unit = {}
-        size = u_gen.get_size()
-        unit_numbers = np.zeros(size, dtype=np.int64)
-        # not int because of possible overflow: OverflowError: Python int too large to convert to C long
-        # https://stackoverflow.com/questions/38314118/overflowerror-python-int-too-large-to-convert-to-c-long-on-windows-but-not-ma
-        unit = u_gen.get_next()
-        pos = [0, 0]
-        while unit is not None:
-            if unit.number not in number_to_unit:
-                number_to_unit[unit.number] = unit
-            unit_numbers[(pos[0], pos[1])] = unit.number
-            pos[1] += 1
-            if pos[1] >= size[1]:
-                pos[0] += 1
-                pos[1] = 0
-            unit = u_gen.get_next()
+        if TiledImage.BULK_EXTRACTION:
+            unit_numbers, number_to_unit = u_gen.get_all()
+        else:
+            unit_numbers, number_to_unit = ImageUnitGenerator.get_all(u_gen)
         return TiledImage(number_to_unit, unit_numbers, u_gen.get_blank())
 
     def from_generated(self, generated):
@@ -134,7 +187,10 @@ class TiledImage:
                         generated[i, j] = self.blank.number
                     else:
                         number_to_unit[generated[i, j]] = self.number_to_unit[generated[i, j]]
-        return TiledImage(number_to_unit, generated, self.blank)
+        tiled_image = TiledImage(number_to_unit, generated, self.blank)
+        tiled_image._atlas_units = self._atlas_units
+        tiled_image._atlases = self._atlases
+        return tiled_image
 
     def _from_generated_get_tiles_for_zelda(self, generated): # TODO remove this
         number_to_unit = {}
@@ -152,23 +208,84 @@ class TiledImage:
                     number_to_unit[number] = unit
         return TiledImage(number_to_unit, generated, blank)
 
-    def get_display_data(self, **kwargs) -> None:
-        repr_datas = []
-        shapes = []
-        for i in range(self.unit_numbers.shape[0]):
-            for j in range(self.unit_numbers.shape[1]):
-                unit = self.number_to_unit[self.unit_numbers[i, j]]
-                repr_datas.append(unit.get_display_data(**kwargs))
-                shapes.append(repr_datas[-1].shape)
-        shapes = np.array(shapes)
-        x_scale = max(shapes[:, 0])
-        y_scale = max(shapes[:, 1])
-        data = np.zeros((x_scale*self.unit_numbers.shape[0], y_scale*self.unit_numbers.shape[1], repr_datas[0].shape[2]), dtype=repr_datas[0].dtype)
-        for i in range(self.unit_numbers.shape[0]):
-            for j in range(self.unit_numbers.shape[1]):
-                c = i*self.unit_numbers.shape[1] + j
-                data[i*x_scale:i*x_scale+shapes[c][0], j*y_scale:j*y_scale+shapes[c][1], :] = repr_datas[c]
-        return data
+    def to_arrays(self) -> dict:
+        # unit table as stacked arrays, for saving with np.savez (only for Tile or Pattern units)
+        numbers = list(self.number_to_unit.keys())
+        units = [self.number_to_unit[number] for number in numbers]
+        arrays = {'unit_numbers': self.unit_numbers.astype(np.int64),
+                  'numbers': np.array(numbers, dtype=np.int64),
+                  'blank': np.array(self.blank.number, dtype=np.int64)}
+        if all(isinstance(unit, Tile) for unit in units):
+            arrays['tile_data'] = np.stack([unit.data for unit in units])
+        elif all(isinstance(unit, Pattern) for unit in units):
+            # patterns share most of their tiles, so the tiles are stored once and patterns as tile indices
+            pattern_data = np.stack([unit.data_array for unit in units])
+            tiles = pattern_data.reshape((-1,) + pattern_data.shape[2:])
+            _, first, tile_indices = np.unique(tiles.reshape(tiles.shape[0], -1), axis=0, return_index=True, return_inverse=True)
+            arrays['pattern_tiles'] = tiles[first]
+            arrays['pattern_tile_indices'] = tile_indices.reshape(pattern_data.shape[:2])
+            arrays['pattern_indices'] = np.stack([unit.pattern_indices for unit in units])
+        else:
+            raise Exception('Only tiled images of Tiles or Patterns can be converted to arrays')
+        return arrays
+
+    def from_arrays(arrays: dict) -> 'TiledImage':
+        numbers = arrays['numbers'].tolist()
+        if 'tile_data' in arrays:
+            units = [Tile(data, number) for data, number in zip(arrays['tile_data'], numbers)]
+        else:
+            pattern_data = arrays['pattern_tiles'][arrays['pattern_tile_indices']]
+            units = [Pattern(data_array, pattern_indices, number)
+                     for data_array, pattern_indices, number in zip(pattern_data, arrays['pattern_indices'], numbers)]
+        number_to_unit = dict(zip(numbers, units))
+        return TiledImage(number_to_unit, arrays['unit_numbers'], number_to_unit[int(arrays['blank'])])
+
+    def save(self, filename) -> None:
+        np.savez(filename, **self.to_arrays())
+
+    def load(filename) -> 'TiledImage':
+        with np.load(filename) as arrays:
+            return TiledImage.from_arrays(dict(arrays))
+
+    def _get_atlas(self, **kwargs):
+        # sorted unit numbers, the (n_units, height, width, channels) uint8 display data of the units in that order
+        # (padded with zeros to the biggest one) and the shape of each of them
+        key = bool(kwargs.get('full_pattern', False)) # the only option that changes the display data of the units (filename doesn't)
+        if key not in self._atlases:
+            numbers = np.array(sorted(self._atlas_units), dtype=np.int64)
+            datas = [np.asarray(self._atlas_units[number].get_display_data(**kwargs)) for number in numbers]
+            shapes = np.array([data.shape[:2] for data in datas])
+            atlas = np.zeros((len(datas), shapes[:, 0].max(), shapes[:, 1].max(), datas[0].shape[2]), dtype=np.uint8)
+            for k, data in enumerate(datas):
+                if data.dtype != np.uint8:
+                    data = np.round(np.clip(data, 0, 1) * 255)
+                atlas[k, :data.shape[0], :data.shape[1]] = data
+            self._atlases[key] = (numbers, atlas, shapes)
+        return self._atlases[key]
+
+    def _get_display_band(self, unit_indices, unit_shape, atlas, start, end):
+        # the display data of the rows [start, end) of units, gathered from the atlas at once
+        units = atlas[unit_indices[start:end], :unit_shape[0], :unit_shape[1]]
+        rows, columns, height, width, channels = units.shape
+        return units.transpose(0, 2, 1, 3, 4).reshape(rows * height, columns * width, channels)
+
+    def _get_display_indices(self, **kwargs):
+        numbers, atlas, shapes = self._get_atlas(**kwargs)
+        unit_indices = np.searchsorted(numbers, np.asarray(self.unit_numbers, dtype=np.int64))
+        used = shapes[np.unique(unit_indices)]
+        return unit_indices, (used[:, 0].max(), used[:, 1].max()), atlas
+
+    def get_display_data(self, **kwargs) -> np.ndarray:
+        # uint8 image of the units, each placed at the top-left of a cell of the size of the biggest unit
+        unit_indices, unit_shape, atlas = self._get_display_indices(**kwargs)
+        return self._get_display_band(unit_indices, unit_shape, atlas, 0, unit_indices.shape[0])
+
+    def save_display_data(self, filename, band_size=16, **kwargs) -> None:
+        # writes the image of get_display_data to a png, band_size rows of units at a time, for images too big to keep in memory
+        unit_indices, unit_shape, atlas = self._get_display_indices(**kwargs)
+        bands = (self._get_display_band(unit_indices, unit_shape, atlas, start, start + band_size)
+                 for start in range(0, unit_indices.shape[0], band_size))
+        write_png(filename, unit_indices.shape[0] * unit_shape[0], unit_indices.shape[1] * unit_shape[1], atlas.shape[3], bands)
 
     def display(self, ax=plt, **kwargs) -> None:
         ax.imshow(self.get_display_data(**kwargs), aspect=1)
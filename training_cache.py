@@ -0,0 +1,78 @@
+import os
+import hashlib
+import numpy as np
+from typing import Tuple
+from tiled_image import ImageUnitGenerator, TiledImage
+from image_distribution import ImageDistribution
+import utility
+
+class TrainingCache:
+    # stores the tiled image and trained distribution of each unit generator as a single .npz file
+    # keyed by the content of the (padded) image, the generator type and its parameters
+    def __init__(self, directory: str='.wfc_cache', max_size: int=2**30):
+        self.directory = directory
+        self.max_size = max_size # bytes, least recently used files are removed above this size
+
+    def get_key(self, u_gen: ImageUnitGenerator) -> str:
+        digest = hashlib.sha256()
+        digest.update(np.ascontiguousarray(u_gen.data).tobytes())
+        digest.update(repr((u_gen.data.shape, str(u_gen.data.dtype))).encode())
+        params = (type(u_gen).__name__, getattr(u_gen, 'tile_size', None), getattr(u_gen, 'n', None), getattr(u_gen, 'm', None),
+                  utility.GLOBAL_HASH_TYPE)
+        digest.update(repr(params).encode())
+        return '{}-{}'.format(type(u_gen).__name__, digest.hexdigest()[:32])
+
+    def _get_filename(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key: str) -> Tuple[TiledImage, ImageDistribution]:
+        filename = self._get_filename(key)
+        if not os.path.exists(filename):
+            return None
+        with np.load(filename) as arrays:
+            arrays = dict(arrays)
+        os.utime(filename) # mark as recently used
+        tiled_image = TiledImage.from_arrays({name[3:]: arr for name, arr in arrays.items() if name.startswith('ti_')})
+        dist = ImageDistribution.from_arrays({name[5:]: arr for name, arr in arrays.items() if name.startswith('dist_')})
+        return tiled_image, dist
+
+    def save(self, key: str, tiled_image: TiledImage, dist: ImageDistribution) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {'ti_' + name: arr for name, arr in tiled_image.to_arrays().items()}
+        arrays.update({'dist_' + name: arr for name, arr in dist.to_arrays().items()})
+        filename = self._get_filename(key)
+        temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(temp_filename, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_filename, filename) # other processes never see a partial file
+        self.evict(keep=filename)
+
+    def get(self, u_gen: ImageUnitGenerator) -> Tuple[TiledImage, ImageDistribution]:
+        key = self.get_key(u_gen)
+        cached = self.load(key)
+        if cached is not None:
+            return cached
+        tiled_image = TiledImage.from_unit_generator(u_gen)
+        dist = ImageDistribution()
+        dist.train(tiled_image)
+        self.save(key, tiled_image, dist)
+        return tiled_image, dist
+
+    def evict(self, keep: str=None) -> None:
+        if not os.path.isdir(self.directory):
+            return
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.npz')]
+        files = [filename for filename in files if filename != keep]
+        files = sorted(files, key=lambda filename: os.stat(filename).st_mtime)
+        total_size = sum(os.stat(filename).st_size for filename in files + ([keep] if keep is not None else []))
+        for filename in files:
+            if total_size <= self.max_size:
+                break
+            total_size -= os.stat(filename).st_size
+            os.remove(filename)
+
+    def clear(self) -> None:
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.directory, name))
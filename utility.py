@@ -1,3 +1,6 @@
+import zlib
+import struct
+import hashlib
 import numpy as np
 
 class Move:
@@ -17,17 +20,73 @@ def add_to_dict(d, key, val=1):
 def in_bound(x: int, y: int, arr: np.ndarray):
     return x >= 0 and y >= 0 and x < arr.shape[0] and y < arr.shape[1]
 
+def luby(i: int) -> int:
+    # i-th (1-based) element of the Luby sequence: 1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8, ...
+    k = 1
+    while (1 << k) - 1 < i:
+        k += 1
+    if i == (1 << k) - 1:
+        return 1 << (k - 1)
+    return luby(i - (1 << (k - 1)) + 1)
+
+def get_seed(seed: int, *coordinates: int) -> int:
+    # a seed that only depends on the given seed and coordinates (e.g. of a chunk), not on the order they are used in
+    entropy = [2 * c if c >= 0 else -2 * c - 1 for c in map(int, (seed,) + coordinates)] # negatives are mapped to odd numbers
+    return int(np.random.SeedSequence(entropy).generate_state(1)[0])
+
+def pack_rows(rows: np.ndarray, base: int) -> np.ndarray:
+    # rows of non-negative integers below base as single keys, in the same (lexicographic) order; int64 if they fit, python ints otherwise
+    dtype = np.int64 if base ** rows.shape[1] <= 2**63 else object
+    keys = np.zeros(len(rows), dtype=dtype)
+    for column in rows.T:
+        keys = keys * base + column.astype(dtype)
+    return keys
+
+def unpack_keys(keys: np.ndarray, base: int, n_columns: int) -> np.ndarray:
+    # inverse of pack_rows
+    columns = []
+    for _ in range(n_columns):
+        columns.insert(0, (keys % base).astype(np.int64))
+        keys = keys // base
+    return np.stack(columns, axis=1).reshape(-1, n_columns)
+
+def count_unique_rows(rows: np.ndarray, order: np.ndarray):
+    # unique rows of a non-negative integer array and their counts, in order of first appearance (smallest order first)
+    rows = rows[np.argsort(order, kind='stable')]
+    if len(rows) == 0:
+        return rows, np.zeros(0, dtype=np.int64)
+    bases = [int(b) + 1 for b in rows.max(axis=0)]
+    multipliers = [1]
+    for base in bases[:0:-1]:
+        multipliers.insert(0, multipliers[0] * base)
+    if multipliers[0] * bases[0] < 2**63: # pack each row into a single int64 key
+        keys = rows.astype(np.int64) @ np.array(multipliers, dtype=np.int64)
+        _, first, counts = np.unique(keys, return_index=True, return_counts=True)
+    else:
+        _, first, counts = np.unique(rows, axis=0, return_index=True, return_counts=True)
+    first_order = np.argsort(first)
+    return rows[first[first_order]], counts[first_order]
+
 class HASH_TYPE:
     PYTHON_HASH = 1 # fast, but unreliable
     # (has randomness that makes different results even with the same seed)
     # https://stackoverflow.com/questions/27522626/hash-function-in-python-3-3-returns-different-results-between-sessions
     NUMBER_HASH = 2 # slow
+    DIGEST_HASH = 3 # fast and deterministic: 64-bit blake2b digest of the bytes
 
-GLOBAL_HASH_TYPE = HASH_TYPE.PYTHON_HASH
+GLOBAL_HASH_TYPE = HASH_TYPE.DIGEST_HASH
+
+def _get_digest(*byte_strings):
+    digest = hashlib.blake2b(digest_size=8)
+    for byte_string in byte_strings:
+        digest.update(byte_string)
+    return int.from_bytes(digest.digest(), 'little', signed=True) # fits in np.int64
 
 def get_array_hash(arr):
     if GLOBAL_HASH_TYPE == HASH_TYPE.PYTHON_HASH:
         return hash(arr.tobytes())
+    elif GLOBAL_HASH_TYPE == HASH_TYPE.DIGEST_HASH:
+        return _get_digest(arr.tobytes())
     elif GLOBAL_HASH_TYPE == HASH_TYPE.NUMBER_HASH:
         big_prime = 1000000007
         out = 0
@@ -43,6 +102,9 @@ def get_array_hash(arr):
 def get_arrays_hash(arr1, arr2):
     if GLOBAL_HASH_TYPE == HASH_TYPE.PYTHON_HASH:
         return hash((arr1.tobytes(), arr2.tobytes()))
+    elif GLOBAL_HASH_TYPE == HASH_TYPE.DIGEST_HASH:
+        arr1_bytes = arr1.tobytes()
+        return _get_digest(len(arr1_bytes).to_bytes(8, 'little'), arr1_bytes, arr2.tobytes())
     elif GLOBAL_HASH_TYPE == HASH_TYPE.NUMBER_HASH:
         # not a good way, but in this case doesn't matter.
         return get_array_hash(arr1) + get_array_hash(arr2)
@@ -50,32 +112,90 @@ def get_arrays_hash(arr1, arr2):
         raise Exception("Unknown hash type")
 
 
+def write_png(filename: str, height: int, width: int, channels: int, bands) -> None:
+    # writes an 8-bit png from bands of rows, (rows, width, channels) uint8 arrays, without holding the whole image in memory
+    def write_chunk(f, kind, data):
+        f.write(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels] # gray, gray + alpha, rgb, rgb + alpha
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        write_chunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0))
+        compressor = zlib.compressobj()
+        for band in bands:
+            rows = band.reshape(band.shape[0], width * channels)
+            rows = np.concatenate([np.zeros((rows.shape[0], 1), dtype=np.uint8), rows], axis=1) # no filter on each row
+            data = compressor.compress(rows.tobytes())
+            if len(data) > 0:
+                write_chunk(f, b'IDAT', data)
+        write_chunk(f, b'IDAT', compressor.flush())
+        write_chunk(f, b'IEND', b'')
+
 class GifMaker:
-    def __init__(self, wfc, tiled_image, is_weighted=True):
+    def __init__(self, wfc, tiled_image, is_weighted=True, gif_name=None, fps=24, repeat=False):
+        # with a gif_name the frames are written to the file as they are added (call save_gif at the end), otherwise they are kept in self.frames
         self.tiled_image = tiled_image
         self.is_weighted = is_weighted
         self.wfc = wfc
         self.frames = []
+        self.writer = None
+        if gif_name is not None:
+            import imageio
+            self.writer = imageio.get_writer(f'./{gif_name}.gif', mode='I', fps=fps, loop=0 if repeat else 1)
+        # display data of all units, in the order of their unit indices: (n_units, tile height, tile width, channels)
+        self.unit_data = np.stack([np.asarray(tiled_image.number_to_unit[unit].get_display_data(), dtype=float) for unit in wfc.dist.units])
+        self._supermap = None # the last rendered supermap
+        self._cells = None # (H, W, tile height, tile width, channels) rendered cells of the last frame
+
+    def __call__(self, wfc, supermap):
+        # as an observer of wfc (see WFC.add_observer), adds a frame after each step
+        self.add_frame(supermap)
+
+    def _get_probabilities(self, supermap, positions):
+        # (len(positions), n_units) probabilities of the units at each of the positions
+        probabilities = np.zeros((len(positions), supermap.shape[2]))
+        for n, (i, j) in enumerate(positions):
+            options = np.flatnonzero(supermap[i, j])
+            if len(options) == 0:
+                continue
+            if self.is_weighted:
+                probabilities[n, options] = self.wfc._get_probabilities(supermap, i, j)
+            else:
+                probabilities[n, options] = 1 / len(options)
+        return probabilities
 
     def add_frame(self, supermap):
-        unit_shape = self.tiled_image.blank.get_display_data().shape
-        frame = np.array([[[0.0 for _ in range(unit_shape[2])]
-                                for _ in range(len(supermap[0]) * unit_shape[1])]
-                                for _ in range(len(supermap) * unit_shape[0])])
-        for i, row in enumerate(supermap):
-            for j, options in enumerate(row):
-                if not self.is_weighted:
-                    probs = np.ones(options.shape) / len(options)
-                else:
-                    probs = self.wfc._get_probabilities(supermap, i, j)
-                for k, option in enumerate(options):
-                    data = np.array(self.tiled_image.number_to_unit[option].get_display_data())
-                    frame[i*unit_shape[0]:(i+1)*unit_shape[0], j*unit_shape[1]:(j+1)*unit_shape[1]] += data * probs[k]
-        self.frames.append((frame * 255).astype(np.uint8))
-
-    def save_gif(self, gif_name, fps=24, repeat=False):
+        if self._cells is None or self._cells.shape[:2] != supermap.shape[:2]:
+            self._cells = np.zeros(supermap.shape[:2] + self.unit_data.shape[1:])
+            changed = np.ones(supermap.shape[:2], dtype=bool)
+        else:
+            # only the positions which changed since the last frame are rendered again (and their neighbors, their weights depend on them)
+            changed = (supermap != self._supermap).any(axis=2)
+            if self.is_weighted:
+                changed[1:] |= changed[:-1].copy()
+                changed[:-1] |= changed[1:].copy()
+                changed[:, 1:] |= changed[:, :-1].copy()
+                changed[:, :-1] |= changed[:, 1:].copy()
+        self._supermap = supermap.copy()
+        positions = list(zip(*np.nonzero(changed)))
+        if len(positions) > 0:
+            # the probability weighted sum of the display data of the units, for all changed positions at once
+            probabilities = self._get_probabilities(supermap, positions)
+            rendered = probabilities @ self.unit_data.reshape(self.unit_data.shape[0], -1)
+            self._cells[changed] = rendered.reshape((len(positions),) + self.unit_data.shape[1:])
+        h, w, th, tw, c = self._cells.shape
+        frame = (self._cells.transpose(0, 2, 1, 3, 4).reshape(h * th, w * tw, c) * 255).astype(np.uint8)
+        if self.writer is not None:
+            self.writer.append_data(frame)
+        else:
+            self.frames.append(frame)
+
+    def save_gif(self, gif_name=None, fps=24, repeat=False):
+        if self.writer is not None:
+            self.writer.close() # the frames are already written
+            self.writer = None
+            return
         import imageio
         imageio.mimsave(f'./{gif_name}.gif',
                         self.frames,
                         fps = fps,
-                        loop = 0 if repeat else 1)
\ No newline at end of file
+                        loop = 0 if repeat else 1)